@@ -0,0 +1,242 @@
+# coding: utf8
+'''Microbenchmarks for the ckanext-restricted hot paths.
+
+Runs offline against the stand-ins of benchmarks/ckan_stubs.py, on
+synthetic datasets mixing every restriction level and large allow-lists,
+and reports the throughput (resources per second) and the CKAN calls
+(authz checks, membership lookups, core actions) of each path.
+
+Usage:
+
+    python benchmarks/bench_hot_paths.py [--sizes 10,100,1000,10000]
+        [--save-baseline] [--compare] [--tolerance 1.5]
+
+--save-baseline writes the results to benchmarks/baseline.json.
+--compare fails (exit status 1) when a path issues more calls than the
+baseline, or its throughput drops below baseline / tolerance.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import ckan_stubs  # noqa: E402
+
+ckan_stubs.install()
+
+import ckan.model  # noqa: E402
+from ckanext.restricted import action  # noqa: E402
+from ckanext.restricted import auth  # noqa: E402
+from ckanext.restricted import logic  # noqa: E402
+
+
+BASELINE_PATH = os.path.join(HERE, 'baseline.json')
+
+LEVELS = ('public', 'registered', 'any_organization',
+          'same_organization', 'only_allowed_users')
+ALLOWED_USERS = 500
+RESOURCES_PER_PACKAGE = 50
+USER = 'user0042'
+ORGANIZATION = {'id': 'org-1', 'name': 'organization-1'}
+
+
+def make_resources(size, seed=0):
+    '''Returns `size` resource dicts spread over datasets of
+    RESOURCES_PER_PACKAGE resources, with restricted values drawn from a
+    pool of distinct policies, as real catalogues share a few.'''
+    rnd = random.Random(seed)
+    users = ['user{0:04d}'.format(i) for i in range(ALLOWED_USERS * 4)]
+    pool = []
+    for i in range(max(len(LEVELS), size // 10)):
+        pool.append(json.dumps({
+            'level': LEVELS[i % len(LEVELS)],
+            'allowed_users': ','.join(rnd.sample(users, ALLOWED_USERS))}))
+
+    resources = []
+    for i in range(size):
+        resource = {
+            'id': 'resource-{0}'.format(i),
+            'package_id': 'package-{0}'.format(i // RESOURCES_PER_PACKAGE),
+            'name': 'Resource {0}'.format(i),
+            'metadata_modified': '2020-01-01T00:00:00',
+            'restricted': rnd.choice(pool)}
+        # as saved by the plugin resource hooks
+        logic.restricted_prepare_resource(resource)
+        resources.append(resource)
+    return resources
+
+
+def make_packages(resources):
+    packages = {}
+    for resource in resources:
+        package = packages.setdefault(resource['package_id'], {
+            'id': resource['package_id'],
+            'name': resource['package_id'],
+            'owner_org': ORGANIZATION['id'],
+            'resources': []})
+        package['resources'].append(resource)
+    for package in packages.values():
+        package['num_resources'] = len(package['resources'])
+    return list(packages.values())
+
+
+def bench_get_restricted_dict(resources, packages):
+    for resource in resources:
+        logic.restricted_get_restricted_dict(resource)
+
+
+def bench_check_user_resource_access(resources, packages):
+    ckan_stubs.new_request(USER)
+    package = packages[0]
+    for resource in resources:
+        logic.restricted_check_user_resource_access(USER, resource, package)
+    ckan_stubs.end_request()
+
+
+def bench_resource_show_auth(resources, packages):
+    # one auth call and context per resource, as check_access does when
+    # rendering a dataset page, without the decision cache
+    ckan_stubs.new_request(USER)
+    package = packages[0]
+    for resource in resources:
+        auth.restricted_resource_show(
+            {'user': USER}, {'resource': resource, 'package': package})
+    ckan_stubs.end_request()
+
+
+def bench_hide_fields(resources, packages):
+    ckan_stubs.new_request(USER)
+    action._restricted_resource_list_hide_fields({'user': USER}, resources)
+    ckan_stubs.end_request()
+
+
+def bench_package_search(resources, packages):
+    ckan_stubs.ACTIONS['core:package_search'] = lambda context, data_dict: {
+        'count': len(packages), 'results': packages}
+    ckan_stubs.new_request(USER)
+    action.restricted_package_search({'user': USER}, {'q': '*:*'})
+    ckan_stubs.end_request()
+
+
+def bench_anonymous_package_show(resources, packages):
+    # every dataset shown once to an anonymous user, served from the
+    # anonymous cache after the first run
+    packages_by_id = dict((package['id'], package) for package in packages)
+    ckan_stubs.ACTIONS['core:package_show'] = \
+        lambda context, data_dict: dict(packages_by_id[data_dict['id']])
+    for package in packages:
+        ckan_stubs.PACKAGES[package['id']] = ckan_stubs.Package(
+            package['id'], datetime.datetime(2020, 1, 1))
+    ckan_stubs.new_request('')
+    for package in packages:
+        action.restricted_package_show(
+            {'user': '', 'model': ckan.model}, {'id': package['id']})
+    ckan_stubs.end_request()
+
+
+BENCHMARKS = (
+    ('restricted_get_restricted_dict', bench_get_restricted_dict),
+    ('restricted_check_user_resource_access', bench_check_user_resource_access),
+    ('restricted_resource_show (auth)', bench_resource_show_auth),
+    ('_restricted_resource_list_hide_fields', bench_hide_fields),
+    ('restricted_package_search', bench_package_search),
+    ('restricted_package_show (anonymous)', bench_anonymous_package_show),
+)
+
+
+def run(sizes, repeat=3):
+    ckan_stubs.ORGANIZATIONS[USER] = [ORGANIZATION]
+    logic._decision_cache.configure(maxsize=0)
+    results = {}
+    for size in sizes:
+        resources = make_resources(size)
+        packages = make_packages(resources)
+        for name, function in BENCHMARKS:
+            # calls of a single run, then the best time over `repeat` runs
+            logic._policy_cache.clear()
+            logic._user_organization_cache.clear()
+            logic._anonymous_package_cache.clear()
+            ckan_stubs.reset_calls()
+            function(resources, packages)
+            calls = dict(ckan_stubs.CALLS)
+
+            number = max(1, 2000 // size)
+            best = min(timeit.repeat(
+                lambda: function(resources, packages),
+                number=number, repeat=repeat)) / number
+
+            results.setdefault(name, {})[str(size)] = {
+                'seconds': best,
+                'resources_per_second': size / best if best else 0,
+                'calls': calls}
+    return results
+
+
+def report(results):
+    for name, sizes in results.items():
+        print(name)
+        for size, result in sorted(sizes.items(), key=lambda i: int(i[0])):
+            calls = ', '.join('{0}={1}'.format(key, value) for key, value
+                              in sorted(result['calls'].items()))
+            print('  {0:>6} resources: {1:>12.0f} res/s  {2:>9.3f} ms  {3}'.format(
+                size, result['resources_per_second'],
+                result['seconds'] * 1000, calls or 'no calls'))
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            expected = baseline.get(name, {}).get(size)
+            if not expected:
+                continue
+            if result['resources_per_second'] < \
+                    expected['resources_per_second'] / tolerance:
+                regressions.append('{0} ({1}): {2:.0f} res/s, baseline {3:.0f}'.format(
+                    name, size, result['resources_per_second'],
+                    expected['resources_per_second']))
+            for call, count in result['calls'].items():
+                if count > expected['calls'].get(call, 0):
+                    regressions.append('{0} ({1}): {2} calls to {3}, baseline {4}'.format(
+                        name, size, count, call, expected['calls'].get(call, 0)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat)
+    report(results)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved to {0}'.format(BASELINE_PATH))
+
+    if args.compare:
+        with open(BASELINE_PATH) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
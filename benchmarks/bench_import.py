@@ -0,0 +1,96 @@
+# coding: utf8
+'''Import time benchmark of ckanext.restricted.plugin.
+
+Every run starts a fresh interpreter, imports the CKAN modules a worker
+loads anyway (ckan.plugins.toolkit, ckan.model, ckan.logic), then the
+plugin, and reports both times, the plugin's share and the modules the
+plugin import added. The median of the runs is reported.
+
+Usage:
+
+    python benchmarks/bench_import.py [--runs 10] [--stubs]
+
+--stubs uses the stand-ins of benchmarks/ckan_stubs.py instead of CKAN,
+to measure the extension alone where CKAN is not installed.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# modules that should only be loaded when mail is sent or a form rendered
+LAZY_MODULES = ('ckan.lib.mailer', 'ckan.lib.base', 'ckan.lib.captcha',
+                'simplejson', 'smtplib', 'ckanext.restricted.mailqueue',
+                'ckanext.restricted.controller')
+
+_PROBE = '''
+import json, sys, time
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {here!r})
+start = time.time()
+if {stubs!r}:
+    import ckan_stubs
+    ckan_stubs.install()
+else:
+    import ckan.plugins.toolkit, ckan.model, ckan.logic
+ckan_seconds = time.time() - start
+before = set(sys.modules)
+start = time.time()
+import ckanext.restricted.plugin
+plugin_seconds = time.time() - start
+print(json.dumps({{
+    'ckan_seconds': ckan_seconds,
+    'plugin_seconds': plugin_seconds,
+    'modules': sorted(set(sys.modules) - before)}}))
+'''
+
+
+def measure(stubs):
+    probe = _PROBE.format(
+        root=os.path.dirname(HERE), here=HERE, stubs=stubs)
+    output = subprocess.check_output([sys.executable, '-c', probe])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--stubs', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = [measure(args.stubs) for i in range(args.runs)]
+    ckan_seconds = median([result['ckan_seconds'] for result in results])
+    plugin_seconds = median([result['plugin_seconds'] for result in results])
+    modules = results[-1]['modules']
+
+    print('CKAN{0}: {1:8.2f} ms'.format(
+        ' (stubs)' if args.stubs else '', ckan_seconds * 1000))
+    print('ckanext.restricted.plugin: {0:8.2f} ms ({1:.1f}% of the total)'.format(
+        plugin_seconds * 1000,
+        100 * plugin_seconds / ((ckan_seconds + plugin_seconds) or 1)))
+    print('Modules added by the plugin: {0}, in the packages:'.format(
+        len(modules)))
+    print('  ' + ', '.join(sorted(set(
+        module.split('.')[0] for module in modules
+        if not module.startswith('_')))))
+
+    eager = [module for module in LAZY_MODULES if module in modules]
+    if eager:
+        print('Loaded eagerly, should be lazy: ' + ', '.join(eager))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
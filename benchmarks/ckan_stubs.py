@@ -0,0 +1,277 @@
+# coding: utf8
+'''In-process stand-ins for the parts of CKAN used by ckanext.restricted.
+
+They let the benchmarks import and run the extension without a CKAN
+install, database or Solr. Every stand-in counts its calls in CALLS so
+the benchmarks can report how many authz checks, membership lookups or
+core actions a code path triggers.
+'''
+
+from __future__ import unicode_literals
+from collections import defaultdict
+import sys
+import types
+
+
+CALLS = defaultdict(int)
+
+# core actions, replaceable by the benchmarks
+ACTIONS = {}
+
+# users that are organization members: {user name: [{id, name}]}
+ORGANIZATIONS = {}
+
+# users that can edit every dataset
+EDITORS = set()
+
+# datasets returned by model.Package.get: {id: Package}
+PACKAGES = {}
+
+# resources granted with restricted_grant_access: {user name: set of ids}
+GRANTS = {}
+
+
+class _Request(object):
+    '''Stands in for the request globals (c / tmpl_context).'''
+
+
+class _RequestProxy(object):
+    '''Proxies the current _Request, like the CKAN LocalProxy does.'''
+
+    current = None
+
+    def __getattr__(self, name):
+        if _RequestProxy.current is None:
+            raise TypeError('No object (name: tmpl_context) has been '
+                            'registered for this thread')
+        return getattr(_RequestProxy.current, name, '')
+
+    def __setattr__(self, name, value):
+        if _RequestProxy.current is None:
+            raise TypeError('No object (name: tmpl_context) has been '
+                            'registered for this thread')
+        setattr(_RequestProxy.current, name, value)
+
+
+c = _RequestProxy()
+
+
+def new_request(user=''):
+    '''Starts a new simulated web request.'''
+    _RequestProxy.current = _Request()
+    _RequestProxy.current.user = user
+    _RequestProxy.current.userobj = None
+
+
+def end_request():
+    _RequestProxy.current = None
+
+
+def reset_calls():
+    CALLS.clear()
+
+
+class NotFound(Exception):
+    pass
+
+
+class NotAuthorized(Exception):
+    pass
+
+
+class ValidationError(Exception):
+    pass
+
+
+class MailerException(Exception):
+    pass
+
+
+class _User(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.id = 'id-' + name
+        self.sysadmin = False
+
+    @classmethod
+    def get(cls, reference):
+        CALLS['model.User.get'] += 1
+        return cls(reference) if reference else None
+
+    def as_dict(self):
+        CALLS['model.User.as_dict'] += 1
+        return {'name': self.name, 'id': self.id, 'sysadmin': self.sysadmin}
+
+
+class Package(object):
+
+    private = False
+    state = 'active'
+
+    def __init__(self, id, metadata_modified):
+        self.id = id
+        self.name = id
+        self.metadata_modified = metadata_modified
+
+    @classmethod
+    def get(cls, reference):
+        CALLS['model.Package.get'] += 1
+        return PACKAGES.get(reference)
+
+
+def _counted(name, function):
+    def wrapper(*args, **kwargs):
+        CALLS[name] += 1
+        return function(*args, **kwargs)
+    wrapper.__name__ = str(name)
+    return wrapper
+
+
+def _is_authorized(action, context, data_dict):
+    CALLS['authz.is_authorized:' + action] += 1
+    if action == 'package_show':
+        # every benchmark dataset is public
+        return {'success': True}
+    return {'success': context.get('user') in EDITORS}
+
+
+def _organization_list_for_user(context, data_dict):
+    return ORGANIZATIONS.get(context.get('user'), [])
+
+
+def _get_action(name):
+    CALLS['get_action:' + name] += 1
+    if name == 'organization_list_for_user':
+        return _counted('organization_list_for_user',
+                        _organization_list_for_user)
+    return ACTIONS[name]
+
+
+def _core_action(name):
+    def action(context, data_dict):
+        CALLS['core:' + name] += 1
+        return ACTIONS['core:' + name](context, data_dict)
+    action.__name__ = str(name)
+    return action
+
+
+def _side_effect_free(function):
+    function.side_effect_free = True
+    return function
+
+
+def _auth_allow_anonymous_access(function):
+    function.auth_allow_anonymous_access = True
+    return function
+
+
+def _check_access(action, context, data_dict=None):
+    if not _is_authorized(action, context, data_dict).get('success'):
+        raise NotAuthorized()
+    return True
+
+
+def _get_resource_ids_for_user(user_name, source=None):
+    CALLS['grants:get_resource_ids_for_user'] += 1
+    return frozenset(GRANTS.get(user_name, ()))
+
+
+def _asbool(value):
+    return str(value).strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+
+
+class _Interface(object):
+    pass
+
+
+class _SingletonPlugin(object):
+    pass
+
+
+def _module(name, **attributes):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(str(name))
+        sys.modules[name] = module
+    module.__dict__.update(attributes)
+    if '.' in name:
+        parent, _, child = name.rpartition('.')
+        setattr(_module(parent), child, module)
+    return module
+
+
+def install():
+    '''Registers the stand-ins as the ckan modules of this process.'''
+    config = {'ckan.site_url': 'http://localhost:5000',
+              'ckan.site_title': 'CKAN'}
+
+    _module('ckan', __version__='stub')
+    _module('ckan.authz',
+            is_authorized=_is_authorized,
+            is_sysadmin=lambda user: False,
+            get_user_id_for_username=_counted(
+                'authz.get_user_id_for_username',
+                lambda user, allow_none=False: user or None))
+    _module('ckan.common', _=lambda text: text, c=c, config=config,
+            request=None, response=None)
+    _module('ckan.lib')
+    _module('ckan.lib.base', render_jinja2=lambda template, extra_vars: '',
+            BaseController=object, c=c)
+    _module('ckan.lib.mailer',
+            mail_recipient=_counted('mailer.mail_recipient',
+                                    lambda *args, **kwargs: None),
+            MailerException=MailerException)
+    _module('ckan.lib.plugins', DefaultTranslation=object)
+    _module('ckan.logic',
+            get_action=_get_action,
+            get_or_bust=lambda data_dict, key: data_dict[key],
+            side_effect_free=_side_effect_free,
+            check_access=_check_access,
+            NotFound=NotFound,
+            NotAuthorized=NotAuthorized,
+            ValidationError=ValidationError)
+    _module('ckan.logic.auth',
+            get_resource_object=lambda context, data_dict: context['resource'])
+    _module('ckan.logic.action')
+    _module('ckan.logic.action.get', **dict(
+        (name, _core_action(name)) for name in (
+            'package_search', 'package_show',
+            'resource_search', 'resource_view_list')))
+    _module('ckan.logic.action.create', **dict(
+        (name, _core_action(name)) for name in (
+            'user_create', 'member_create', 'organization_member_create')))
+    _module('ckan.logic.action.delete', **dict(
+        (name, _core_action(name)) for name in (
+            'member_delete', 'organization_member_delete', 'user_delete')))
+    _module('ckan.model', User=_User, Package=Package)
+    plugins = _module('ckan.plugins',
+                      SingletonPlugin=_SingletonPlugin,
+                      implements=lambda *args, **kwargs: None)
+    for interface in ('ITranslation', 'IConfigurer', 'IConfigurable',
+                      'IActions', 'ITemplateHelpers', 'IAuthFunctions',
+                      'IRoutes', 'IResourceController', 'IPackageController'):
+        setattr(plugins, interface, _Interface)
+    _module('ckan.plugins.toolkit',
+            c=c,
+            config=config,
+            get_action=_get_action,
+            check_access=_check_access,
+            auth_allow_anonymous_access=_auth_allow_anonymous_access,
+            side_effect_free=_side_effect_free,
+            asint=int,
+            asbool=_asbool,
+            url_for=lambda *args, **kwargs: '/dataset',
+            ObjectNotFound=NotFound,
+            NotAuthorized=NotAuthorized,
+            ValidationError=ValidationError)
+
+    # the grant table queries, registered without their parent package so
+    # the rest of ckanext.restricted is imported from the source tree
+    grants = types.ModuleType(str('ckanext.restricted.model'))
+    grants.__dict__.update(
+        SOURCE_METADATA='metadata', SOURCE_ACTION='action',
+        get_resource_ids_for_user=_get_resource_ids_for_user,
+        get_user_names_for_resources=lambda resource_ids: set())
+    sys.modules['ckanext.restricted.model'] = grants
+    return config
@@ -4,19 +4,24 @@ from __future__ import unicode_literals
 import ckan.authz as authz
 from ckan.common import _
 
-from ckan.lib.base import render_jinja2
-from ckan.lib.mailer import mail_recipient
-from ckan.lib.mailer import MailerException
 import ckan.logic
+from ckan.logic.action.create import member_create
+from ckan.logic.action.create import organization_member_create
 from ckan.logic.action.create import user_create
+from ckan.logic.action.delete import member_delete
+from ckan.logic.action.delete import organization_member_delete
+from ckan.logic.action.delete import user_delete
 from ckan.logic.action.get import package_search
 from ckan.logic.action.get import package_show
 from ckan.logic.action.get import resource_search
 from ckan.logic.action.get import resource_view_list
 from ckan.logic import side_effect_free
+import ckan.plugins.toolkit as toolkit
 from ckanext.restricted import auth
 from ckanext.restricted import logic
-import json
+from ckanext.restricted import stats
+import datetime
+import itertools
 
 try:
     # CKAN 2.7 and later
@@ -33,6 +38,9 @@ _get_or_bust = ckan.logic.get_or_bust
 
 NotFound = ckan.logic.NotFound
 
+# number of resources requested to resource_search at once when filtering
+RESOURCE_SEARCH_PAGE_SIZE = 100
+
 
 def restricted_user_create_and_notify(context, data_dict):
 
@@ -45,6 +53,11 @@ def restricted_user_create_and_notify(context, data_dict):
 
     user_dict = user_create(context, data_dict)
 
+    # mail dependencies are loaded on first use, not at plugin load
+    from ckan.lib.base import render_jinja2
+    from ckan.lib.mailer import MailerException
+    from ckanext.restricted import mailqueue
+
     # Send your email, check ckan.lib.mailer for params
     try:
         name = _('CKAN System Administrator')
@@ -63,7 +76,7 @@ def restricted_user_create_and_notify(context, data_dict):
         body = render_jinja2(
             'restricted/emails/restricted_user_registered.txt', extra_vars)
 
-        mail_recipient(name, email, subject, body)
+        mailqueue.mail_recipient(name, email, subject, body)
 
     except MailerException as mailer_exception:
         log.error('Cannot send mail after registration')
@@ -72,6 +85,40 @@ def restricted_user_create_and_notify(context, data_dict):
     return (user_dict)
 
 
+def restricted_member_create(context, data_dict):
+    member_dict = member_create(context, data_dict)
+    if data_dict.get('object_type') == 'user':
+        logic.restricted_invalidate_user_organizations(
+            data_dict.get('object'), context)
+    return member_dict
+
+
+def restricted_member_delete(context, data_dict):
+    member_delete(context, data_dict)
+    if data_dict.get('object_type') == 'user':
+        logic.restricted_invalidate_user_organizations(
+            data_dict.get('object'), context)
+
+
+def restricted_organization_member_create(context, data_dict):
+    member_dict = organization_member_create(context, data_dict)
+    logic.restricted_invalidate_user_organizations(
+        data_dict.get('username'), context)
+    return member_dict
+
+
+def restricted_organization_member_delete(context, data_dict):
+    organization_member_delete(context, data_dict)
+    logic.restricted_invalidate_user_organizations(
+        data_dict.get('username', data_dict.get('user_id')), context)
+
+
+def restricted_user_delete(context, data_dict):
+    user_delete(context, data_dict)
+    logic.restricted_invalidate_user_organizations(
+        data_dict.get('id'), context)
+
+
 @side_effect_free
 def restricted_resource_view_list(context, data_dict):
     model = context['model']
@@ -90,62 +137,111 @@ def restricted_resource_view_list(context, data_dict):
 @side_effect_free
 def restricted_package_show(context, data_dict):
 
-    package_metadata = package_show(context, data_dict)
+    # anonymous outputs only depend on the dataset version, they are
+    # shared by all anonymous calls
+    cache_key = logic.restricted_get_anonymous_cache_key(context, data_dict)
+    if cache_key is not None:
+        toolkit.check_access('package_show', context, data_dict)
+        package_metadata = logic.restricted_get_anonymous_package(cache_key)
+        if package_metadata is not None:
+            return package_metadata
 
-    # Ensure user who can edit can see the resource
-    if authz.is_authorized(
-            'package_update', context, package_metadata).get('success', False):
-        return package_metadata
+    package_metadata = _restricted_package_metadata(
+        context, package_show(context, data_dict))
 
-    # Custom authorization
-    if isinstance(package_metadata, dict):
-        restricted_package_metadata = dict(package_metadata)
-    else:
-        restricted_package_metadata = dict(package_metadata.for_json())
-
-    # restricted_package_metadata['resources'] = _restricted_resource_list_url(
-    #     context, restricted_package_metadata.get('resources', []))
-    restricted_package_metadata['resources'] = _restricted_resource_list_hide_fields(
-        context, restricted_package_metadata.get('resources', []))
-
-    restricted_package_metadata['resources'] = filter(
-        lambda x: x.get('restricted', '') == '' or json.loads(x['restricted'])['level'] == 'public',
-        restricted_package_metadata.get('resources', [])
-        )
-    restricted_package_metadata['num_resources'] = len(
-        restricted_package_metadata['resources'])
-    return (restricted_package_metadata)
+    if cache_key is not None:
+        logic.restricted_cache_anonymous_package(cache_key, package_metadata)
+    return package_metadata
 
 
 @side_effect_free
 def restricted_resource_search(context, data_dict):
-    resource_search_result = resource_search(context, data_dict)
-
-    restricted_resource_search_result = {}
-
-    for key, value in resource_search_result.items():
-        if key == 'results':
-            # restricted_resource_search_result[key] = \
-            #     _restricted_resource_list_url(context, value)
-            restricted_resource_search_result[key] = \
-                _restricted_resource_list_hide_fields(context, value)
-        else:
-            restricted_resource_search_result[key] = value
+    # offset and limit apply to the visible resources, the underlying
+    # resource_search pages are pulled lazily until the page is full
+    offset = int(data_dict.get('offset') or 0)
+    limit = data_dict.get('limit')
+    limit = int(limit) if limit is not None else None
+
+    counts = {'count': None, 'hidden': 0, 'exact': False}
+    visible_resources = _restricted_iter_resource_search(
+        context, data_dict, offset + limit if limit is not None else None,
+        counts)
+    results = list(itertools.islice(
+        visible_resources, offset,
+        offset + limit if limit is not None else None))
+
+    if counts['count'] is None:
+        counts['count'] = resource_search(
+            context, dict(data_dict, offset=0, limit=0))['count']
+        counts['exact'] = not counts['count']
 
-    # Remove restricted resources.
     # Note, that private resources are now excluded from search even for admins.
     # An admin should go to package page to find a resource.
-    restricted_resource_search_result['results'] = filter(
-        lambda x: x.get('restricted', '') == '' or json.loads(x['restricted'])['level'] == 'public',
-        restricted_resource_search_result['results']
-        )
-    restricted_resource_search_result['count'] = len(
-        restricted_resource_search_result['results'])
-    return restricted_resource_search_result
+    # The count excludes the restricted resources of the pages read, so it
+    # is exact (count_exact) once the last page has been read, and an
+    # upper bound before.
+    return {
+        'count': counts['count'] - counts['hidden'],
+        'count_exact': counts['exact'],
+        'results': _restricted_resource_list_hide_fields(context, results)}
+
+
+def _restricted_iter_resource_search(context, data_dict, wanted, counts):
+    # pages are sized to the visible resources still wanted, scaled by the
+    # share of hidden resources seen so far (at least
+    # RESOURCE_SEARCH_PAGE_SIZE), so a deep page is usually one or two calls
+    search_dict = dict(data_dict)
+    search_offset = 0
+    visible = 0
+    while True:
+        page_size = RESOURCE_SEARCH_PAGE_SIZE
+        if wanted is not None:
+            missing = wanted - visible
+            if visible:
+                missing = -(-missing * search_offset // visible)
+            page_size = max(missing, page_size)
+        search_dict['offset'] = search_offset
+        search_dict['limit'] = page_size
+        resource_search_result = resource_search(context, search_dict)
+        page = resource_search_result.get('results', [])
+        counts['count'] = resource_search_result.get('count', 0)
+        search_offset += len(page)
+        last_page = len(page) < page_size or search_offset >= counts['count']
+
+        # Remove restricted resources, counted for the whole page before
+        # the caller stops reading
+        visible_page = [resource for resource in page
+                        if _restricted_is_public_resource(resource)]
+        counts['hidden'] += len(page) - len(visible_page)
+        counts['exact'] = last_page
+        for resource in visible_page:
+            visible += 1
+            yield resource
+
+        if last_page:
+            return
 
 
 @side_effect_free
 def restricted_package_search(context, data_dict):
+    # include_restricted=False only returns datasets with at least one
+    # resource the user can access, filtered by Solr so counts are right
+    data_dict = dict(data_dict)
+    # the restriction fields are only queried by this action
+    for key in ('q', 'fq', 'fl', 'facet.field', 'sort'):
+        if 'vocab_restricted_' in '{0}'.format(data_dict.get(key) or ''):
+            raise ckan.logic.ValidationError(
+                {key: [_('Cannot query the restriction fields')]})
+    # fl returns the Solr fields as is (res_url, validated_data_dict...),
+    # only full dataset dicts can be filtered
+    data_dict.pop('fl', None)
+    if not toolkit.asbool(data_dict.pop('include_restricted', True)):
+        fq = logic.restricted_get_search_fq(
+            logic.restricted_get_username_from_context(context), context)
+        if fq:
+            data_dict['fq'] = '{0} +{1}'.format(
+                data_dict.get('fq', ''), fq).strip()
+
     package_search_result = package_search(context, data_dict)
 
     restricted_package_search_result = {}
@@ -154,8 +250,12 @@ def restricted_package_search(context, data_dict):
         if key == 'results':
             restricted_package_search_result_list = []
             for package in value:
+                # package_update auth caches the package object in the
+                # context, use a fresh one for every dataset
+                package_context = dict(context)
+                package_context.pop('package', None)
                 restricted_package_search_result_list.append(
-                    restricted_package_show(context, {'id': package.get('id')}))
+                    _restricted_package_metadata(package_context, package))
             restricted_package_search_result[key] = \
                 restricted_package_search_result_list
         else:
@@ -163,8 +263,16 @@ def restricted_package_search(context, data_dict):
 
     return restricted_package_search_result
 
+
 @side_effect_free
 def restricted_check_access(context, data_dict):
+    '''Checks the user access to a resource.
+
+    The decision includes an ``etag``. Pass it back as ``if_none_match``
+    to get the cached decision, with ``not_modified`` set, without
+    checking the access again while the resource, the dataset and the
+    memberships are unchanged.
+    '''
 
     package_id = data_dict.get('package_id', False)
     resource_id = data_dict.get('resource_id', False)
@@ -176,6 +284,12 @@ def restricted_check_access(context, data_dict):
     if not resource_id:
         raise ckan.logic.ValidationError('Missing resource_id')
 
+    etag = logic.restricted_get_access_etag(context, package_id, resource_id)
+    if etag and data_dict.get('if_none_match') == etag:
+        decision = logic.restricted_get_cached_decision(('etag', etag))
+        if decision is not None:
+            return dict(decision, etag=etag, not_modified=True)
+
     log.debug("action.restricted_check_access: user_name = " + str(user_name))
 
     log.debug("checking package " + str(package_id))
@@ -183,7 +297,329 @@ def restricted_check_access(context, data_dict):
     log.debug("checking resource")
     resource_dict = ckan.logic.get_action('resource_show')(dict(context, return_type='dict'), {'id': resource_id})
 
-    return logic.restricted_check_user_resource_access(user_name, resource_dict, package_dict)
+    decision = logic.restricted_check_user_resource_access(
+        user_name, resource_dict, package_dict, context)
+    if etag:
+        logic.restricted_cache_decision(('etag', etag), decision)
+        decision = dict(decision, etag=etag)
+    return decision
+
+
+@side_effect_free
+def restricted_check_access_batch(context, data_dict):
+    '''Checks the user access to several resources at once.
+
+    :param resource_ids: the ids of the resources to check
+    :type resource_ids: list or comma separated string
+    :param package_id: the id or name of a dataset, to check all its
+        resources, or only those of resource_ids when both are given
+    :type package_id: string
+
+    :returns: the decision for every resource, keyed by resource id
+    :rtype: dictionary
+    '''
+    model = context['model']
+
+    resource_ids = data_dict.get('resource_ids', [])
+    package_id = data_dict.get('package_id', False)
+    if not isinstance(resource_ids, (list, tuple)):
+        resource_ids = [id.strip() for id in resource_ids.split(',')]
+    resource_ids = [id for id in resource_ids if id]
+
+    if not resource_ids and not package_id:
+        raise ckan.logic.ValidationError('Missing resource_ids or package_id')
+
+    user_name = logic.restricted_get_username_from_context(context)
+
+    decisions = dict(
+        (id, {'success': False, 'msg': 'Resource not found'})
+        for id in resource_ids)
+
+    query = model.Session.query(model.Resource).filter(
+        model.Resource.state == 'active')
+    if package_id:
+        package = model.Package.get(package_id)
+        if not package:
+            raise NotFound('Dataset not found')
+        query = query.filter(model.Resource.package_id == package.id)
+    if resource_ids:
+        query = query.filter(model.Resource.id.in_(resource_ids))
+    resources = query.all()
+
+    packages = {}
+    package_ids = set(resource.package_id for resource in resources)
+    if package_ids:
+        for package in model.Session.query(
+                model.Package.id, model.Package.owner_org,
+                model.Package.private, model.Package.state).filter(
+                    model.Package.id.in_(package_ids)):
+            packages[package.id] = package
+
+    # private datasets are checked once, with the package_show auth
+    readable_packages = {}
+    for package in packages.values():
+        if package.state != 'active':
+            readable_packages[package.id] = False
+        elif package.private:
+            package_context = dict(context)
+            package_context.pop('package', None)
+            readable_packages[package.id] = authz.is_authorized(
+                'package_show', package_context, {'id': package.id}
+                ).get('success', False)
+        else:
+            readable_packages[package.id] = True
+
+    for resource in resources:
+        if not readable_packages.get(resource.package_id, False):
+            decisions[resource.id] = {
+                'success': False, 'msg': 'Resource not found'}
+            continue
+        decisions[resource.id] = logic.restricted_check_user_resource_access(
+            user_name,
+            {'id': resource.id, 'extras': resource.extras},
+            {'owner_org': packages[resource.package_id].owner_org},
+            context)
+
+    return decisions
+
+@side_effect_free
+def restricted_stats(context, data_dict):
+    '''Returns the call counts, latency histograms, SQL statements and
+    membership lookups of the actions and auth functions overridden by
+    this extension (if ckanext.restricted.stats_enabled), and the stats of
+    its caches. Sysadmins only.
+
+    :param reset: reset the call stats after returning them
+    :type reset: bool
+    '''
+    toolkit.check_access('restricted_stats', context, data_dict)
+
+    result = {
+        'enabled': stats.is_enabled(),
+        'functions': stats.get_stats(),
+        'caches': {
+            'membership': logic.restricted_get_user_organization_cache_stats(),
+            'policy': logic.restricted_get_policy_cache_stats(),
+            'group_members': logic.restricted_get_group_member_cache_stats(),
+            'anonymous_package':
+                logic.restricted_get_anonymous_package_cache_stats(),
+            'decision': logic.restricted_get_decision_cache_stats()}}
+
+    if toolkit.asbool(data_dict.get('reset', False)):
+        stats.reset_stats()
+    return result
+
+
+def restricted_grant_access(context, data_dict):
+    '''Grants users access to a restricted resource, whatever its level.
+
+    The grants are kept in the restricted_grant table instead of the
+    resource allowed_users, which suits allow-lists of thousands of users.
+
+    :param resource_id: the id of the resource
+    :type resource_id: string
+    :param users: the names or ids of the users
+    :type users: list or comma separated string
+
+    :returns: the names of the users granted, and of those already granted
+    :rtype: dictionary
+    '''
+    from ckanext.restricted import model as restricted_model
+
+    toolkit.check_access('restricted_grant_access', context, data_dict)
+    resource, users = _restricted_get_grant_resource_and_users(
+        context, data_dict)
+
+    added = set(restricted_model.grant(
+        resource.id, set(user.id for user in users.values()),
+        granted_by=logic.restricted_get_identity(context)['id'] or None))
+    _restricted_grants_changed(context, resource)
+
+    names = set(user.name for user in users.values())
+    granted = set(user.name for user in users.values() if user.id in added)
+    return {'resource_id': resource.id,
+            'granted': sorted(granted),
+            'already_granted': sorted(names - granted)}
+
+
+def restricted_revoke_access(context, data_dict):
+    '''Revokes the access granted with restricted_grant_access.
+
+    Users listed in the resource allowed_users keep their access until
+    they are removed from it by updating the resource.
+
+    :param resource_id: the id of the resource
+    :type resource_id: string
+    :param users: the names or ids of the users
+    :type users: list or comma separated string
+
+    :returns: the number of grants revoked
+    :rtype: dictionary
+    '''
+    from ckanext.restricted import model as restricted_model
+
+    toolkit.check_access('restricted_revoke_access', context, data_dict)
+    resource, users = _restricted_get_grant_resource_and_users(
+        context, data_dict)
+
+    allowed_users = logic.restricted_get_restriction_policy(
+        {'restricted': resource.extras.get('restricted')}).allowed_users
+    listed = sorted(set(
+        user.name for user in users.values() if user.name in allowed_users))
+    if listed:
+        raise ckan.logic.ValidationError({'users': [_(
+            'Listed in the resource allowed users: {0}').format(
+            ', '.join(listed))]})
+
+    revoked = restricted_model.revoke(
+        resource.id, set(user.id for user in users.values()),
+        source=restricted_model.SOURCE_ACTION)
+    _restricted_grants_changed(context, resource)
+    return {'resource_id': resource.id, 'revoked': revoked}
+
+
+@side_effect_free
+def restricted_grant_list(context, data_dict):
+    '''Lists the grants of a resource, or of a user.
+
+    Includes the grants mirrored from the resources allowed_users, with
+    source 'metadata', and those of restricted_grant_access, with source
+    'action'.
+
+    :param resource_id: the id of the resource
+    :type resource_id: string
+    :param user_id: the name or id of the user, to list the resources
+        granted to this user instead
+    :type user_id: string
+    :param limit: the maximum number of grants returned (default 1000)
+    :type limit: int
+    :param offset: the number of grants skipped (default 0)
+    :type offset: int
+
+    :returns: the total count and the grants
+    :rtype: dictionary
+    '''
+    from ckanext.restricted import model as restricted_model
+
+    model = context['model']
+    toolkit.check_access('restricted_grant_list', context, data_dict)
+
+    resource_id = data_dict.get('resource_id')
+    user_id = data_dict.get('user_id')
+    if not resource_id and not user_id:
+        raise ckan.logic.ValidationError('Missing resource_id or user_id')
+    if user_id:
+        user = model.User.get(user_id)
+        if not user:
+            raise NotFound('User not found')
+        user_id = user.id
+
+    try:
+        limit = int(data_dict.get('limit', 1000))
+        offset = int(data_dict.get('offset', 0))
+    except ValueError:
+        raise ckan.logic.ValidationError('limit and offset must be integers')
+
+    grants, count = restricted_model.get_grants(
+        resource_id=resource_id, user_id=user_id, limit=limit, offset=offset)
+    return {'count': count, 'results': grants}
+
+
+@side_effect_free
+def restricted_access_request_list(context, data_dict):
+    '''Lists the access requests sent with the request access form, most
+    recently made first. Sysadmins can list all of them, dataset editors
+    those of their datasets.
+
+    :param package_id: the id or name of a dataset
+    :type package_id: string
+    :param resource_id: the id of a resource
+    :type resource_id: string
+    :param user_id: the name or id of the user who made the requests
+    :type user_id: string
+    :param status: only the requests with this status, e.g. 'pending'
+    :type status: string
+    :param limit: the maximum number of requests returned (default 20)
+    :type limit: int
+    :param offset: the number of requests skipped (default 0)
+    :type offset: int
+
+    :returns: the total count and the requests
+    :rtype: dictionary
+    '''
+    from ckanext.restricted import model as restricted_model
+
+    model = context['model']
+    toolkit.check_access('restricted_access_request_list', context, data_dict)
+
+    package_id = data_dict.get('package_id')
+    if package_id:
+        package = model.Package.get(package_id)
+        if not package:
+            raise NotFound('Dataset not found')
+        package_id = package.id
+    user_id = data_dict.get('user_id')
+    if user_id:
+        user = model.User.get(user_id)
+        if not user:
+            raise NotFound('User not found')
+        user_id = user.id
+
+    try:
+        limit = int(data_dict.get('limit', 20))
+        offset = int(data_dict.get('offset', 0))
+    except ValueError:
+        raise ckan.logic.ValidationError('limit and offset must be integers')
+
+    access_requests, count = restricted_model.get_access_requests(
+        package_id=package_id, resource_id=data_dict.get('resource_id'),
+        user_id=user_id, status=data_dict.get('status'),
+        limit=limit, offset=offset)
+    return {'count': count, 'results': access_requests}
+
+
+def _restricted_get_grant_resource_and_users(context, data_dict):
+    model = context['model']
+    resource = model.Resource.get(_get_or_bust(data_dict, 'resource_id'))
+    if not resource or resource.state != 'active':
+        raise NotFound('Resource not found')
+
+    user_ids = data_dict.get('users', [])
+    if not isinstance(user_ids, (list, tuple)):
+        user_ids = [id.strip() for id in user_ids.split(',')]
+    user_ids = [id for id in user_ids if id]
+    if not user_ids:
+        raise ckan.logic.ValidationError({'users': [_('Missing value')]})
+
+    users = logic.restricted_get_users_by_name_or_id(user_ids, context)
+    unknown = [id for id in user_ids if id not in users]
+    if unknown:
+        raise ckan.logic.ValidationError({'users': [_(
+            'Users not found: {0}').format(', '.join(unknown))]})
+    return resource, users
+
+
+def _restricted_grants_changed(context, resource):
+    # a new resource and dataset version invalidates the decisions, etags
+    # and anonymous outputs cached by every process, not only this one
+    model = context['model']
+    now = datetime.datetime.utcnow()
+    if 'metadata_modified' in model.resource_table.c:
+        model.Session.execute(model.resource_table.update().where(
+            model.resource_table.c.id == resource.id).values(
+            metadata_modified=now))
+    model.Session.execute(model.package_table.update().where(
+        model.package_table.c.id == resource.package_id).values(
+        metadata_modified=now))
+    if not context.get('defer_commit'):
+        context['model'].repo.commit()
+    logic.restricted_invalidate_user_grants(context)
+    logic.restricted_invalidate_package(resource.package_id)
+
+    # the granted users are indexed with the dataset, for package_search
+    import ckan.lib.search as search
+    search.rebuild(resource.package_id)
+
 
 # def _restricted_resource_list_url(context, resource_list):
 #     restricted_resources_list = []
@@ -196,39 +632,79 @@ def restricted_check_access(context, data_dict):
 #         restricted_resources_list += [restricted_resource]
 #     return restricted_resources_list
 
-def _restricted_resource_list_hide_fields(context, resource_list):
+def _restricted_package_metadata(context, package_metadata):
+
+    # Ensure user who can edit can see the resource
+    if authz.is_authorized(
+            'package_update', context, package_metadata).get('success', False):
+        if isinstance(package_metadata, dict):
+            for resource in package_metadata.get('resources', []):
+                resource.pop('restricted_masked', None)
+        return package_metadata
+
+    # Custom authorization
+    if isinstance(package_metadata, dict):
+        restricted_package_metadata = dict(package_metadata)
+    else:
+        restricted_package_metadata = dict(package_metadata.for_json())
+
+    # restricted_package_metadata['resources'] = _restricted_resource_list_url(
+    #     context, restricted_package_metadata.get('resources', []))
+    # the package_update check above already failed for this dataset
+    restricted_package_metadata['resources'] = _restricted_resource_list_hide_fields(
+        context, restricted_package_metadata.get('resources', []),
+        {restricted_package_metadata.get('id'): False})
+
+    restricted_package_metadata['resources'] = [
+        resource for resource in restricted_package_metadata['resources']
+        if _restricted_is_public_resource(resource)]
+    restricted_package_metadata['num_resources'] = len(
+        restricted_package_metadata['resources'])
+    return (restricted_package_metadata)
+
+
+def _restricted_is_public_resource(resource):
+    return (resource.get('restricted', '') == '' or
+            logic.restricted_compile_policy(
+                resource['restricted']).level == logic.RestrictionLevel.PUBLIC)
+
+
+def _restricted_resource_list_hide_fields(
+        context, resource_list, can_edit_packages=None):
     restricted_resources_list = []
-    for resource in resource_list:
-        # copy original resource
-        restricted_resource = dict(resource)
 
-        # get the restricted fields
-        restricted_dict = logic.restricted_get_restricted_dict(restricted_resource)
+    # decided once per package / user / restricted value
+    can_edit_packages = dict(can_edit_packages or {})
+    user_name = None
+    masked_restricted = {}
 
-        # hide fields to unauthorized users
-        authorized = auth.restricted_resource_show(
-            context, {'id': resource.get('id'), 'resource': resource}
-            ).get('success', False)
+    for resource in resource_list:
+        # copy original resource, the masked value is never shown as is
+        restricted_resource = dict(resource)
+        restricted_resource.pop('restricted_masked', None)
 
         # hide other fields in restricted to everyone but dataset owner(s)
-        if not authz.is_authorized(
-                'package_update', context, {'id': resource.get('package_id')}
-                ).get('success'):
-
-            user_name = logic.restricted_get_username_from_context(context)
-
-            # hide partially other allowed user_names (keep own)
-            allowed_users = []
-            for user in restricted_dict.get('allowed_users'):
-                if len(user.strip()) > 0:
-                    if user_name == user:
-                        allowed_users.append(user_name)
-                    else:
-                        allowed_users.append(user[0:3] + '*****' + user[-2:])
-
-            new_restricted = json.dumps({
-                'level': restricted_dict.get("level"),
-                'allowed_users': ','.join(allowed_users)})
+        package_id = resource.get('package_id')
+        if package_id not in can_edit_packages:
+            package_context = dict(context)
+            package_context.pop('package', None)
+            can_edit_packages[package_id] = authz.is_authorized(
+                'package_update', package_context, {'id': package_id}
+                ).get('success')
+
+        if not can_edit_packages[package_id]:
+            if user_name is None:
+                user_name = logic.restricted_get_username_from_context(context)
+
+            # get the restricted fields
+            policy = logic.restricted_get_restriction_policy(restricted_resource)
+
+            new_restricted = masked_restricted.get(policy)
+            if new_restricted is None:
+                new_restricted = logic.restricted_get_masked_restricted(
+                    resource, policy, user_name, context)
+                masked_restricted[policy] = new_restricted
+
             extras_restricted = resource.get('extras', {}).get('restricted', {})
             if (extras_restricted):
                 restricted_resource['extras']['restricted'] = new_restricted
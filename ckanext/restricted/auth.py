@@ -18,7 +18,29 @@ def restricted_resource_show(context, data_dict=None):
     if not resource:
         resource = logic_auth.get_resource_object(context, data_dict)
     if type(resource) is not dict:
-        resource = resource.as_dict()
+        # only the restricted field, package_id and version are needed
+        resource = {
+            'id': resource.id,
+            'package_id': resource.package_id,
+            'metadata_modified': getattr(
+                resource, 'metadata_modified', None),
+            'extras': resource.extras}
+
+    # Repeated checks of the same resource version by the same user
+    cache_key = logic.restricted_get_decision_cache_key(context, resource)
+    if cache_key is not None:
+        decision = logic.restricted_get_cached_decision(cache_key)
+        if decision is not None:
+            return decision
+
+    decision = _restricted_resource_show(context, data_dict, resource)
+
+    if cache_key is not None:
+        logic.restricted_cache_decision(cache_key, decision)
+    return decision
+
+
+def _restricted_resource_show(context, data_dict, resource):
 
     if authz.is_authorized(
             'package_update', context,
@@ -29,9 +51,50 @@ def restricted_resource_show(context, data_dict=None):
 
     package = data_dict.get('package', {})
     if not package:
-        model = context['model']
-        package = model.Package.get(resource.get('package_id'))
-        package = package.as_dict()
+        package = logic.restricted_get_package_access_dict(
+            resource.get('package_id'), context)
 
     return (logic.restricted_check_user_resource_access(
-        user_name, resource, package))
+        user_name, resource, package, context))
+
+
+def restricted_grant_access(context, data_dict):
+    return _restricted_resource_package_update(context, data_dict)
+
+
+def restricted_revoke_access(context, data_dict):
+    return _restricted_resource_package_update(context, data_dict)
+
+
+def restricted_grant_list(context, data_dict):
+    # users can list their own grants, editors those of their resources
+    if data_dict.get('user_id') and not data_dict.get('resource_id'):
+        identity = logic.restricted_get_identity(context)
+        if data_dict['user_id'] in (identity['name'], identity['id']) \
+                and identity['name']:
+            return {'success': True}
+        return {'success': False}
+    return _restricted_resource_package_update(context, data_dict)
+
+
+def restricted_access_request_list(context, data_dict):
+    # sysadmins only, unless filtered on a dataset or resource the user
+    # can edit
+    if data_dict.get('package_id'):
+        return authz.is_authorized(
+            'package_update', context, {'id': data_dict['package_id']})
+    if data_dict.get('resource_id'):
+        return _restricted_resource_package_update(context, data_dict)
+    return {'success': False}
+
+
+def _restricted_resource_package_update(context, data_dict):
+    resource = logic_auth.get_resource_object(
+        context, {'id': data_dict.get('resource_id')})
+    return authz.is_authorized(
+        'package_update', context, {'id': resource.package_id})
+
+
+def restricted_stats(context, data_dict=None):
+    # sysadmins only, they are authorized before reaching this function
+    return {'success': False}
@@ -0,0 +1,162 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    '''Bounded, thread safe, in-process cache.
+
+    Entries are evicted in least recently used order once `maxsize` is
+    reached, and expire `ttl` seconds after being set (no expiration if
+    `ttl` is None or 0). A `maxsize` of 0 disables the cache.
+    '''
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    # re-insert as most recently used
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def configure(self, maxsize=None, ttl=None):
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._data.clear()
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio}
+
+
+class DirectoryCache(object):
+    '''Cache of text values in files, shared by the processes that use
+    the same directory.
+
+    Values are grouped by namespace (one sub directory each) so all the
+    values of a namespace can be deleted at once. Files are written to a
+    temporary name then renamed, so readers never see partial values.
+    Values expire `ttl` seconds after being written (no expiration if
+    `ttl` is None or 0).
+    '''
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _namespace_dir(self, namespace):
+        return os.path.join(
+            self.directory, hashlib.sha1(namespace.encode('utf8')).hexdigest())
+
+    def _path(self, namespace, key):
+        return os.path.join(
+            self._namespace_dir(namespace),
+            hashlib.sha1(repr(key).encode('utf8')).hexdigest())
+
+    def get(self, namespace, key, default=None):
+        path = self._path(namespace, key)
+        try:
+            if self.ttl and os.path.getmtime(path) + self.ttl < time.time():
+                raise OSError('expired')
+            with open(path, 'rb') as f:
+                value = f.read().decode('utf8')
+        except (IOError, OSError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, namespace, key, value):
+        directory = self._namespace_dir(namespace)
+        try:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process, or not writable
+                if not os.path.isdir(directory):
+                    raise
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value.encode('utf8'))
+            os.rename(tmp_path, self._path(namespace, key))
+        except (IOError, OSError) as e:
+            log.warning('Could not write to the cache directory {0}: {1}'.format(
+                self.directory, e))
+
+    def delete(self, namespace):
+        shutil.rmtree(self._namespace_dir(namespace), ignore_errors=True)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'directory': self.directory,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / total if total else 0.0}
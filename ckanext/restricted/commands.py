@@ -0,0 +1,270 @@
+# coding: utf8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from ckan.lib.cli import CkanCommand
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class RestrictedCommand(CkanCommand):
+    '''ckanext-restricted maintenance commands
+
+    Usage:
+
+        restricted send-mail
+            - Sends the mails queued in ckanext.restricted.mail_spool_dir.
+              Run it periodically (e.g. from cron) when the spool is enabled.
+
+        restricted send-digest
+            - Sends the maintainers a digest of the access requests made
+              since the last one. Run it periodically (e.g. daily from cron)
+              when ckanext.restricted.access_request_digest is enabled.
+
+        restricted migrate-grants
+            - Creates the restricted_grant table if needed and fills it with
+              the allowed users of the existing resources. Safe to run again.
+
+        restricted set-policy SELECTOR... POLICY... [dry-run] [batch-size=N]
+            - Sets the restriction of many resources at once, in a single
+              transaction, then reindexes every dataset changed once.
+              SELECTOR (combined with AND):
+                org=NAME           resources of the organization's datasets
+                dataset=PATTERN    of the datasets whose name matches, with
+                                   * as wildcard (e.g. dataset=census-*)
+                ids-file=PATH      listed in the file, one resource or
+                                   dataset id or name per line
+              POLICY, updating the given keys only:
+                level=LEVEL        public, registered, any_organization,
+                                   same_organization or only_allowed_users
+                allowed_users=a,b  allowed user names
+                allowed_groups=g   allowed groups, see README
+                policy=JSON        several keys at once
+              dry-run reports the changes without saving them.
+
+        restricted access-matrix [format=csv|jsonl] [output=PATH]
+                [include-denied] [expand-registered]
+            - Writes which users can access which restricted resources (or
+              resources of private datasets), a row per user and resource
+              with the reason: sysadmin, editor, allowed_user,
+              allowed_group, grant or the restriction level. Resources open
+              to every registered user get a single row for user "*" unless
+              expand-registered. include-denied adds the denied users too.
+              Writes to the standard output unless output is given.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = None
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'send-mail':
+            self.send_mail()
+        elif cmd == 'send-digest':
+            self.send_digest()
+        elif cmd == 'migrate-grants':
+            self.migrate_grants()
+        elif cmd == 'set-policy':
+            self.set_policy()
+        elif cmd == 'access-matrix':
+            self.access_matrix()
+        else:
+            print('Command "{0}" not recognized'.format(cmd))
+            print(self.usage)
+
+    def send_mail(self):
+        from ckanext.restricted import mailqueue
+
+        result = mailqueue.send_queued()
+        print('Sent: {sent}, to retry: {retried}, failed: {failed}, '
+              'queued again: {requeued}'.format(**result))
+
+    def send_digest(self):
+        from ckanext.restricted import logic
+
+        result = logic.restricted_send_access_request_digests()
+        print('Access requests: {requests}, mails sent: {mails}'.format(
+            **result))
+
+    def migrate_grants(self):
+        import ckan.model as model
+        from ckanext.restricted import logic
+        from ckanext.restricted import model as restricted_model
+
+        restricted_model.setup()
+        context = {'model': model, 'user': '', 'defer_commit': True}
+
+        batch = []
+        migrated = 0
+        for resource_id, restricted in \
+                restricted_model.iter_restricted_resources():
+            batch.append({'id': resource_id, 'restricted': restricted})
+            if len(batch) >= restricted_model.BATCH_SIZE:
+                logic.restricted_sync_grants(context, batch)
+                migrated += len(batch)
+                batch = []
+                print('{0} resources migrated'.format(migrated))
+        if batch:
+            logic.restricted_sync_grants(context, batch)
+            migrated += len(batch)
+        model.repo.commit()
+        print('Done, {0} resources with a restriction migrated'.format(
+            migrated))
+
+    def _parse_options(self):
+        options = {}
+        for arg in self.args[1:]:
+            key, sep, value = arg.partition('=')
+            options[key.strip()] = value.strip() if sep else True
+        return options
+
+    def set_policy(self):
+        import datetime
+        import json
+        import ckan.model as model
+        from ckanext.restricted import logic
+        from ckanext.restricted import model as restricted_model
+
+        options = self._parse_options()
+        dry_run = bool(options.pop('dry-run', False))
+        batch_size = int(options.pop('batch-size', restricted_model.BATCH_SIZE))
+
+        policy = {}
+        if 'policy' in options:
+            policy.update(json.loads(options.pop('policy')))
+        for key in ('level', 'allowed_users', 'allowed_groups'):
+            if key in options:
+                policy[key] = options.pop(key)
+        levels = [value for name, value in vars(logic.RestrictionLevel).items()
+                  if not name.startswith('_')]
+        if not policy or policy.get('level', levels[0]) not in levels:
+            print('Missing or invalid policy')
+            print(self.usage)
+            return
+
+        ids = None
+        if 'ids-file' in options:
+            with open(options.pop('ids-file')) as f:
+                ids = [line.strip() for line in f if line.strip()]
+        organization_id = None
+        if 'org' in options:
+            organization = model.Group.get(options.pop('org'))
+            if not organization:
+                print('Organization not found')
+                return
+            organization_id = organization.id
+        dataset_pattern = options.pop('dataset', None)
+        if options or (ids is None and not organization_id and
+                       not dataset_pattern):
+            print('Missing selector or unknown options: {0}'.format(
+                ', '.join(options) or '-'))
+            print(self.usage)
+            return
+
+        rows = restricted_model.get_resources_to_restrict(
+            organization_id, dataset_pattern, ids)
+        print('{0} resources selected in {1} datasets'.format(
+            len(rows), len(set(package_id for _id, package_id in rows))))
+
+        # all the batches are written in a single transaction with table
+        # updates, so no ORM change triggers the automatic indexing on
+        # commit, and datasets are reindexed once committed
+        from sqlalchemy import bindparam
+        values = {'extras': bindparam('_extras')}
+        now = datetime.datetime.utcnow()
+        if 'metadata_modified' in model.resource_table.c:
+            values['metadata_modified'] = now
+        update = model.resource_table.update().where(
+            model.resource_table.c.id == bindparam('_id')).values(**values)
+        context = {'model': model, 'user': '', 'defer_commit': True}
+        changed_packages = set()
+        changed = 0
+        for start in range(0, len(rows), batch_size):
+            batch = dict(rows[start:start + batch_size])
+            resources = model.Session.query(
+                model.Resource.id, model.Resource.package_id,
+                model.Resource.extras).filter(
+                model.Resource.id.in_(list(batch))).all()
+            updated = []
+            for resource_id, package_id, extras in resources:
+                extras = dict(extras or {})
+                restricted = extras.get('restricted') or {}
+                if not isinstance(restricted, dict):
+                    try:
+                        restricted = json.loads(restricted)
+                    except ValueError:
+                        restricted = {}
+                new_resource = {
+                    'restricted': dict(restricted or {}, **policy)}
+                logic.restricted_prepare_resource(new_resource)
+                if new_resource['restricted'] == extras.get('restricted') \
+                        and new_resource.get('restricted_masked') == \
+                        extras.get('restricted_masked'):
+                    continue
+                changed += 1
+                changed_packages.add(package_id)
+                extras.update(new_resource)
+                updated.append({'_id': resource_id, '_extras': extras})
+            if updated and not dry_run:
+                model.Session.execute(update, updated)
+                logic.restricted_sync_grants(context, [
+                    {'id': row['_id'],
+                     'restricted': row['_extras']['restricted']}
+                    for row in updated])
+            print('{0}/{1} resources processed, {2} to change'.format(
+                min(start + batch_size, len(rows)), len(rows), changed))
+
+        if dry_run:
+            model.Session.rollback()
+            print('Dry run: {0} resources in {1} datasets would change'.format(
+                changed, len(changed_packages)))
+            return
+
+        if changed_packages:
+            model.Session.execute(model.package_table.update().where(
+                model.package_table.c.id.in_(list(changed_packages))).values(
+                metadata_modified=now))
+        model.repo.commit()
+        print('{0} resources changed in {1} datasets, reindexing'.format(
+            changed, len(changed_packages)))
+
+        import ckan.lib.search as search
+        for count, package_id in enumerate(sorted(changed_packages), 1):
+            search.rebuild(package_id)
+            logic.restricted_invalidate_package(package_id)
+            if count % 100 == 0 or count == len(changed_packages):
+                print('{0}/{1} datasets reindexed'.format(
+                    count, len(changed_packages)))
+
+    def access_matrix(self):
+        import io
+        import sys
+        from ckanext.restricted import report
+
+        options = self._parse_options()
+        output_format = options.pop('format', 'csv')
+        output_path = options.pop('output', None)
+        rows = report.iter_access_matrix(
+            include_denied=bool(options.pop('include-denied', False)),
+            expand_registered=bool(options.pop('expand-registered', False)))
+        writers = {'csv': report.write_csv, 'jsonl': report.write_jsonl}
+        if options or output_format not in writers:
+            print('Invalid format or unknown options: {0}'.format(
+                ', '.join(options) or output_format))
+            print(self.usage)
+            return
+
+        if not output_path:
+            count = writers[output_format](rows, sys.stdout)
+        elif output_format == 'csv' and sys.version_info[0] < 3:
+            with open(output_path, 'wb') as f:
+                count = report.write_csv(rows, f)
+        else:
+            with io.open(output_path, 'w', encoding='utf8', newline='') as f:
+                count = writers[output_format](rows, f)
+        print('{0} rows written'.format(count), file=sys.stderr)
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 from ckan.common import _
 from ckan.common import request
+from ckan.common import response
 import ckan.lib.base as base
 from ckan.lib.base import render_jinja2
 import ckan.lib.captcha as captcha
@@ -12,6 +13,8 @@ import ckan.lib.navl.dictization_functions as dictization_functions
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import logic as restricted_logic
+from ckanext.restricted import mailqueue
 
 try:
     # CKAN 2.7 and later
@@ -44,7 +47,7 @@ class RestrictedController(toolkit.BaseController):
         except logic.NotAuthorized:
             base.abort(401, _('Not authorized to see this page'))
 
-    def _send_request_mail(self, data):
+    def _send_request_mail(self, data, maintainers=True):
         success = False
         try:
 
@@ -85,13 +88,15 @@ class RestrictedController(toolkit.BaseController):
                 data.get('maintainer_email'): extra_vars.get('maintainer_name'),
                 extra_vars.get('admin_email_to'): '{} Admin'.format(extra_vars.get('site_title'))}
 
-            headers = {
-                'CC': ",".join(email_dict.keys()),
-                'reply-to': data.get('user_email')}
+            headers = {'reply-to': data.get('user_email')}
+            if maintainers:
+                headers['CC'] = ",".join(email_dict.keys())
 
             # CC doesn't work and mailer cannot send to multiple addresses
-            for email, name in email_dict.iteritems():
-                mailer.mail_recipient(name, email, subject, body, headers)
+            if maintainers:
+                for email, name in email_dict.iteritems():
+                    mailqueue.mail_recipient(
+                        name, email, subject, body, headers)
 
             # Special copy for the user (no links)
             email = data.get('user_email')
@@ -102,12 +107,19 @@ class RestrictedController(toolkit.BaseController):
             body = render_jinja2(
                 'restricted/emails/restricted_access_request.txt', extra_vars)
 
-            body_user = _(
-                'Please find below a copy of the access '
-                'request mail sent. \n\n >> {}'
-            ).format(body.replace("\n", "\n >> "))
-
-            mailer.mail_recipient(
+            if maintainers:
+                body_user = _(
+                    'Please find below a copy of the access '
+                    'request mail sent. \n\n >> {}'
+                ).format(body.replace("\n", "\n >> "))
+            else:
+                body_user = _(
+                    'Please find below a copy of your access request. The '
+                    'dataset maintainers will receive it with the next '
+                    'digest of access requests. \n\n >> {}'
+                ).format(body.replace("\n", "\n >> "))
+
+            mailqueue.mail_recipient(
                 name, email, 'Fwd: ' + subject, body_user, headers)
             success = True
 
@@ -161,12 +173,44 @@ class RestrictedController(toolkit.BaseController):
                 package_id=data_dict.get('package-name'),
                 resource_id=data_dict.get('resource'))
 
-        success = self._send_request_mail(data_dict)
+        access_request = self._save_request(context, data_dict, pkg)
+
+        if toolkit.asbool(config.get(
+                'ckanext.restricted.access_request_digest', False)):
+            # maintainers get the request in the next digest, the user a
+            # copy of the first request only
+            success = access_request is not None
+            if success and access_request.request_count == 1:
+                success = self._send_request_mail(data_dict, maintainers=False)
+        else:
+            success = self._send_request_mail(data_dict)
 
         return render(
             'restricted/restricted_request_access_result.html',
             extra_vars={'data': data_dict, 'pkg_dict': pkg, 'success': success})
 
+    def _save_request(self, context, data_dict, pkg):
+        '''Stores the request, merged into the pending request of the user
+        for the resource if any. The user, resource and maintainer are
+        taken from the database, not from the submitted form.'''
+        from ckanext.restricted import model as restricted_model
+
+        resource = model.Resource.get(data_dict.get('resource_id'))
+        user = model.User.get(context['user'])
+        if not resource or not user or resource.package_id != pkg['id']:
+            log.warning('Access request not saved, resource "{0}" not found '
+                        'in "{1}"'.format(data_dict.get('resource_id'),
+                                          pkg['id']))
+            return None
+
+        contact_details = self._get_contact_details(pkg)
+        access_request = restricted_model.save_access_request(
+            resource.id, pkg['id'], user.id, data_dict.get('message'),
+            contact_details.get('contact_name'),
+            contact_details.get('contact_email'))
+        model.repo.commit()
+        return access_request
+
     def restricted_request_access_form(
             self, package_id, resource_id,
             data=None, errors=None, error_summary=None):
@@ -187,6 +231,7 @@ class RestrictedController(toolkit.BaseController):
         if (context['save']) and not data and not errors:
             return self._send_request(context)
 
+        blank_form = not data
         if not data:
             data['package_id'] = package_id
             data['resource_id'] = resource_id
@@ -224,6 +269,21 @@ class RestrictedController(toolkit.BaseController):
         else:
             pkg = data.get('pkg_dict', {})
 
+        # the blank form only changes with the dataset, the resource, the
+        # user (name and email shown) and the language, browsers revalidate
+        # it with If-None-Match once the resource is known to be shown
+        if blank_form and request.method == 'GET':
+            etag = restricted_logic.restricted_get_access_etag(
+                context, package_id, resource_id, h.lang(),
+                data['user_name'], data['user_email'])
+            if etag:
+                response.headers['ETag'] = str(etag)
+                response.headers['Cache-Control'] = str('private, no-cache')
+                # webob matches the tags without their quotes
+                if etag.strip('"') in request.if_none_match:
+                    response.status_int = 304
+                    return ''
+
         extra_vars = {
             'pkg_dict': pkg, 'data': data,
             'errors': errors, 'error_summary': error_summary}
@@ -1,8 +1,48 @@
-# coding: utf8 
+# coding: utf8
 
 
 from ckan.common import c
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import logic
 
 
 def restricted_get_user_id():
     return (str(c.user))
+
+
+def restricted_get_resources_access(pkg):
+    '''Returns the access of the current user to all the resources of a
+    dataset, evaluated once per request and dataset:
+
+        {'can_edit': bool, 'user_id': str, 'authorized': {res_id: bool}}
+    '''
+    memo = logic.restricted_get_request_memo().setdefault(
+        'resources_access', {})
+    if pkg.get('id') in memo:
+        return memo[pkg.get('id')]
+
+    context = {'model': model, 'user': c.user, 'auth_user_obj': c.userobj}
+    try:
+        toolkit.check_access('package_update', context, {'id': pkg.get('id')})
+        can_edit = True
+    except toolkit.NotAuthorized:
+        can_edit = False
+
+    authorized = {}
+    if can_edit:
+        for resource in pkg.get('resources', []):
+            authorized[resource.get('id')] = True
+    else:
+        user_name = logic.restricted_get_username_from_context(context)
+        for resource in pkg.get('resources', []):
+            authorized[resource.get('id')] = \
+                logic.restricted_check_user_resource_access(
+                    user_name, resource, pkg, context).get('success', False)
+
+    resources_access = {
+        'can_edit': can_edit,
+        'user_id': restricted_get_user_id(),
+        'authorized': authorized}
+    memo[pkg.get('id')] = resources_access
+    return resources_access
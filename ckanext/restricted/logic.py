@@ -4,11 +4,14 @@ from __future__ import unicode_literals
 import ckan.authz as authz
 from ckan.common import _
 
-from ckan.lib.base import render_jinja2
-import ckan.lib.mailer as mailer
 import ckan.logic as logic
 import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import cache
+from ckanext.restricted import stats
+import hashlib
+import hmac
 import json
+import time
 
 try:
     # CKAN 2.7 and later
@@ -22,57 +25,626 @@ from logging import getLogger
 log = getLogger(__name__)
 
 
+_REQUEST_MEMO_KEY = 'restricted_request_memo'
+
+# user name -> {organization id: organization name}, shared by requests
+_user_organization_cache = cache.LRUCache(maxsize=1000, ttl=300)
+
+# raw restricted string -> RestrictionPolicy
+_policy_cache = cache.LRUCache(maxsize=10000)
+
+# allowed groups of a policy -> frozenset of the names of their members
+_group_member_cache = cache.LRUCache(maxsize=1000, ttl=300)
+
+# package id -> {show options: (metadata_modified, JSON of the anonymous
+# package_show output)}, optionally backed by a directory shared by workers
+_anonymous_package_cache = cache.LRUCache(maxsize=1000, ttl=300)
+_anonymous_package_dir_cache = [None]
+
+# (user, resource id, resource metadata_modified, membership generation,
+#  package generation) -> resource_show auth decision
+_decision_cache = cache.LRUCache(maxsize=10000, ttl=300)
+
+# bumped on every membership change seen by this process, and per dataset
+# on every dataset update, to invalidate cached decisions implicitly
+_membership_generation = [0]
+_package_generations = {}
+
+
+def restricted_configure_caches(config_):
+    _user_organization_cache.configure(
+        maxsize=toolkit.asint(config_.get(
+            'ckanext.restricted.membership_cache_size', 1000)),
+        ttl=toolkit.asint(config_.get(
+            'ckanext.restricted.membership_cache_ttl', 300)))
+    _policy_cache.configure(
+        maxsize=toolkit.asint(config_.get(
+            'ckanext.restricted.policy_cache_size', 10000)))
+    _group_member_cache.configure(
+        maxsize=toolkit.asint(config_.get(
+            'ckanext.restricted.group_cache_size', 1000)),
+        ttl=toolkit.asint(config_.get(
+            'ckanext.restricted.group_cache_ttl', 300)))
+    anonymous_cache_enabled = toolkit.asbool(config_.get(
+        'ckanext.restricted.anonymous_cache_enabled', True))
+    anonymous_cache_ttl = toolkit.asint(config_.get(
+        'ckanext.restricted.anonymous_cache_ttl', 300))
+    _anonymous_package_cache.configure(
+        maxsize=toolkit.asint(config_.get(
+            'ckanext.restricted.anonymous_cache_size', 1000))
+        if anonymous_cache_enabled else 0,
+        ttl=anonymous_cache_ttl)
+    anonymous_cache_dir = config_.get('ckanext.restricted.anonymous_cache_dir')
+    _anonymous_package_dir_cache[0] = cache.DirectoryCache(
+        anonymous_cache_dir, ttl=anonymous_cache_ttl) \
+        if anonymous_cache_enabled and anonymous_cache_dir else None
+    decision_cache_enabled = toolkit.asbool(config_.get(
+        'ckanext.restricted.decision_cache_enabled', True))
+    _decision_cache.configure(
+        maxsize=toolkit.asint(config_.get(
+            'ckanext.restricted.decision_cache_size', 10000))
+        if decision_cache_enabled else 0,
+        ttl=toolkit.asint(config_.get(
+            'ckanext.restricted.decision_cache_ttl', 300)))
+
+
 def restricted_get_username_from_context(context):
+    return restricted_get_identity(context)['name']
+
+
+def restricted_get_identity(context):
+    '''Returns the name, id and sysadmin flag of the user in the context.
+
+    Resolved once and kept in the context and the request memo, so every
+    restriction function called during the request reuses it.
+    '''
+    user = context.get('user', '')
+    identity = context.get('__restricted_identity')
+    if identity is not None and identity['user'] == user:
+        return identity
+
     auth_user_obj = context.get('auth_user_obj', None)
-    user_name = ''
-    if auth_user_obj:
-        user_name = auth_user_obj.as_dict().get('name', '')
-    else:
-        if authz.get_user_id_for_username(context.get('user'), allow_none=True):
-            user_name = context.get('user', '')
-    return user_name
+    identities = restricted_get_request_memo(context).setdefault(
+        'identities', {})
+    identity = identities.get(user) if not auth_user_obj else None
+    if identity is None:
+        if not auth_user_obj and user:
+            model = context.get('model')
+            if model is None:
+                import ckan.model as model
+            auth_user_obj = model.User.get(user)
+        identity = {'user': user, 'name': '', 'id': '', 'sysadmin': False}
+        if auth_user_obj:
+            identity.update({
+                'name': auth_user_obj.name,
+                'id': auth_user_obj.id,
+                'sysadmin': bool(auth_user_obj.sysadmin)})
+        identities[user] = identity
 
+    context['__restricted_identity'] = identity
+    return identity
+
+
+def restricted_get_request_memo(context=None):
+    '''Returns a dict that lives as long as the current request.
+
+    Inside a web request the memo is kept on the request globals, so it
+    is shared by every check made while rendering the page, even when
+    they use different action contexts. Outside a request (paster
+    commands, background jobs) it falls back to the given context.
+    '''
+    try:
+        memo = getattr(toolkit.c, _REQUEST_MEMO_KEY, None)
+        if not isinstance(memo, dict):
+            memo = {}
+            setattr(toolkit.c, _REQUEST_MEMO_KEY, memo)
+        return memo
+    except (TypeError, RuntimeError, AttributeError):
+        # No request registered for this thread
+        pass
+
+    if context is None:
+        return {}
+    return context.setdefault('__' + _REQUEST_MEMO_KEY, {})
+
+
+def restricted_get_user_organization_dict(user, context=None):
+    '''Returns the {id: name} dict of organizations the user is member of.
+
+    The lookup is done once per user and request, repeated calls are
+    served from the request memo and counted in
+    'organization_lookups_saved'. Across requests the result is kept in
+    a bounded TTL cache that is dropped when the user membership changes
+    (see restricted_invalidate_user_organizations).
+    '''
+    memo = restricted_get_request_memo(context)
+    organizations = memo.setdefault('user_organizations', {})
+    if user in organizations:
+        memo['organization_lookups_saved'] = \
+            memo.get('organization_lookups_saved', 0) + 1
+        return organizations[user]
+
+    user_organization_dict = _user_organization_cache.get(user)
+    if user_organization_dict is not None:
+        organizations[user] = user_organization_dict
+        return user_organization_dict
+
+    stats.count_membership_lookup()
+    user_organization_dict = {}
+    for org in logic.get_action('organization_list_for_user')(
+            {'user': user}, {'permission': 'read'}):
+        name = org.get('name', '')
+        id = org.get('id', '')
+        if name and id:
+            user_organization_dict[id] = name
+
+    organizations[user] = user_organization_dict
+    _user_organization_cache.set(user, user_organization_dict)
+    return user_organization_dict
+
+
+def restricted_invalidate_user_organizations(user_id, context=None):
+    '''Drops the cached memberships of a user given its id or name, and
+    the expanded members of the allowed groups.'''
+    if not user_id:
+        return
+    keys = set([user_id])
+    model = (context or {}).get('model')
+    if model is None:
+        import ckan.model as model
+    user_obj = model.User.get(user_id)
+    if user_obj:
+        keys.update([user_obj.id, user_obj.name])
+
+    organizations = restricted_get_request_memo(context).get(
+        'user_organizations', {})
+    for key in keys:
+        _user_organization_cache.pop(key)
+        organizations.pop(key, None)
+    restricted_get_request_memo(context).pop('user_group_entries', None)
+    _group_member_cache.clear()
+    _membership_generation[0] += 1
+
+
+def restricted_get_membership_generation():
+    return _membership_generation[0]
+
+
+def restricted_invalidate_package(package_id):
+    '''Invalidates the cached decisions on the resources of a dataset and
+    its cached anonymous package_show outputs.'''
+    _package_generations[package_id] = \
+        _package_generations.get(package_id, 0) + 1
+    _anonymous_package_cache.pop(package_id)
+    if _anonymous_package_dir_cache[0] is not None:
+        _anonymous_package_dir_cache[0].delete(package_id)
+
+
+# context keys changing the package_show output, or the resources shown
+# (ignore_auth shows them all, e.g. to the search indexer)
+_ANONYMOUS_CACHE_UNSAFE_CONTEXT = (
+    'ignore_auth', 'schema', 'for_edit', 'return_type', 'keep_email',
+    'keep_apikey')
+
+
+def restricted_get_anonymous_cache_key(context, data_dict):
+    '''Returns the anonymous package_show cache key of the dataset, or
+    None if the output cannot be cached: caller logged in, ignore_auth,
+    validate=False or another output changing context key, private, draft
+    or deleted dataset.
+
+    Loads the dataset with a single query and keeps it in
+    context['package'], where the package_show auth function finds it.
+    '''
+    if not _anonymous_package_cache.maxsize or \
+            restricted_get_identity(context)['name']:
+        return None
+    if not context.get('validate', True) or any(
+            context.get(key) for key in _ANONYMOUS_CACHE_UNSAFE_CONTEXT):
+        return None
+    model = context['model']
+    package = model.Package.get(data_dict.get('id'))
+    if not package or package.private or package.state != 'active' or \
+            not package.metadata_modified:
+        return None
+    context['package'] = package
+
+    options = tuple(sorted(
+        (key, '{0}'.format(value)) for key, value in data_dict.items()
+        if key != 'id')) + (('for_view', bool(context.get('for_view'))),)
+    return (package.id, package.metadata_modified.isoformat(), options)
+
+
+def restricted_get_anonymous_package(cache_key):
+    '''Returns a copy of the cached anonymous package_show output, or None.'''
+    package_id, metadata_modified, options = cache_key
+    entry = (_anonymous_package_cache.get(package_id) or {}).get(options)
+    if entry is None and _anonymous_package_dir_cache[0] is not None:
+        value = _anonymous_package_dir_cache[0].get(package_id, options)
+        if value is not None:
+            entry = tuple(value.split('\n', 1))
+            _restricted_set_anonymous_entry(package_id, options, entry)
+    if entry is None or entry[0] != metadata_modified:
+        return None
+    return json.loads(entry[1])
+
+
+def restricted_cache_anonymous_package(cache_key, package_dict):
+    package_id, metadata_modified, options = cache_key
+    entry = (metadata_modified, json.dumps(package_dict))
+    _restricted_set_anonymous_entry(package_id, options, entry)
+    if _anonymous_package_dir_cache[0] is not None:
+        _anonymous_package_dir_cache[0].set(
+            package_id, options, '\n'.join(entry))
+
+
+def _restricted_set_anonymous_entry(package_id, options, entry):
+    entries = _anonymous_package_cache.get(package_id)
+    if entries is None:
+        entries = {}
+        _anonymous_package_cache.set(package_id, entries)
+    entries[options] = entry
+
+
+def restricted_get_user_grants(user_name, context=None):
+    '''Returns the ids of the resources granted to the user with the
+    restricted_grant_access action, loaded once per request.'''
+    if not user_name:
+        return frozenset()
+    grants = restricted_get_request_memo(context).setdefault('grants', {})
+    if user_name not in grants:
+        from ckanext.restricted import model as restricted_model
+        grants[user_name] = restricted_model.get_resource_ids_for_user(
+            user_name, source=restricted_model.SOURCE_ACTION)
+    return grants[user_name]
+
+
+def restricted_invalidate_user_grants(context=None):
+    restricted_get_request_memo(context).pop('grants', None)
+
+
+def restricted_sync_grants(context, resources):
+    '''Mirrors the allowed_users of the resources in the restricted_grant
+    table, so they can be listed and searched by user.
+
+    Resources without an id (not created yet) are skipped. Does not
+    commit, the changes are committed with the calling action.
+    '''
+    allowed_users = dict(
+        (resource['id'], restricted_get_restriction_policy(
+            resource).allowed_users)
+        for resource in resources or [] if resource.get('id'))
+    if not allowed_users:
+        return
+    from ckanext.restricted import model as restricted_model
+
+    users = restricted_get_users_by_name_or_id(
+        set().union(*allowed_users.values()), context)
+    restricted_model.sync_metadata_grants(dict(
+        (resource_id, set(users[name].id for name in names if name in users))
+        for resource_id, names in allowed_users.items()),
+        granted_by=restricted_get_identity(context)['id'] or None)
+
+
+def restricted_get_decision_cache_key(context, resource_dict):
+    '''Returns the decision cache key for the user in the context and the
+    resource, or None if the decision cannot be cached.
+
+    The key includes the resource metadata_modified and the membership
+    and dataset generations, so edits invalidate the entries implicitly.
+    Decisions made with ignore_auth are not about the user and are not
+    cached.
+    '''
+    if not _decision_cache.maxsize or context.get('ignore_auth'):
+        return None
+    metadata_modified = resource_dict.get('metadata_modified')
+    if not metadata_modified or not resource_dict.get('id'):
+        return None
+    package_id = resource_dict.get('package_id')
+    return (context.get('user') or '',
+            resource_dict['id'],
+            str(metadata_modified),
+            _membership_generation[0],
+            package_id,
+            _package_generations.get(package_id, 0))
+
+
+def restricted_get_cached_decision(cache_key):
+    decision = _decision_cache.get(cache_key)
+    return dict(decision) if decision is not None else None
+
+
+def restricted_cache_decision(cache_key, decision):
+    _decision_cache.set(cache_key, dict(decision))
+
+
+def restricted_get_access_etag(context, package_id, resource_id, *extra):
+    '''Returns an entity tag for the access of the user in the context to
+    a resource, or None if the resource is not found in the dataset.
+
+    It changes with the resource and dataset metadata_modified, the user,
+    the membership and dataset generations of this process, and at least
+    every decision cache TTL, which bounds the staleness of changes made
+    in other processes. `extra` values are added to the tag.
+    '''
+    model = context['model']
+    from sqlalchemy import or_
+
+    row = model.Session.query(
+        model.Resource.metadata_modified, model.Package.id,
+        model.Package.metadata_modified).join(
+        model.Package, model.Package.id == model.Resource.package_id).filter(
+        model.Resource.id == resource_id).filter(
+        or_(model.Package.id == package_id,
+            model.Package.name == package_id)).first()
+    if not row:
+        return None
+
+    ttl = _decision_cache.ttl or 300
+    validator = '\n'.join('{0}'.format(value) for value in (
+        restricted_get_identity(context)['name'], resource_id, row[0],
+        row[1], row[2], _membership_generation[0],
+        _package_generations.get(row[1], 0), int(time.time() // ttl)) + extra)
+    return '"{0}"'.format(
+        hashlib.sha1(validator.encode('utf8')).hexdigest())
+
+
+def restricted_get_policy_cache_stats():
+    return _policy_cache.stats()
+
+
+def restricted_get_decision_cache_stats():
+    return _decision_cache.stats()
+
+
+def restricted_get_anonymous_package_cache_stats():
+    stats_ = _anonymous_package_cache.stats()
+    if _anonymous_package_dir_cache[0] is not None:
+        stats_['directory'] = _anonymous_package_dir_cache[0].stats()
+    return stats_
+
+
+def restricted_get_group_member_cache_stats():
+    return _group_member_cache.stats()
+
+
+def restricted_get_user_organization_cache_stats():
+    return _user_organization_cache.stats()
+
+
+def restricted_get_organization_lookups_saved(context=None):
+    return restricted_get_request_memo(context).get(
+        'organization_lookups_saved', 0)
+
+
+def restricted_get_package_access_dict(package_id, context=None):
+    '''Returns the owner_org and private values of a dataset, the only
+    package fields needed to check the access to its resources.
+
+    Loaded with a single column query and memoized for the request.
+    '''
+    packages = restricted_get_request_memo(context).setdefault(
+        'package_access', {})
+    if package_id in packages:
+        return packages[package_id]
+
+    model = (context or {}).get('model')
+    if model is None:
+        import ckan.model as model
+    row = model.Session.query(
+        model.Package.owner_org, model.Package.private).filter(
+            model.Package.id == package_id).first()
+    package_dict = {}
+    if row:
+        package_dict = {'owner_org': row.owner_org, 'private': row.private}
+
+    packages[package_id] = package_dict
+    return package_dict
+
+
+class RestrictionLevel(object):
+    PUBLIC = 'public'
+    REGISTERED = 'registered'
+    ANY_ORGANIZATION = 'any_organization'
+    SAME_ORGANIZATION = 'same_organization'
+    ONLY_ALLOWED_USERS = 'only_allowed_users'
+
+
+# organization and group roles, each including the permissions of the
+# previous ones
+GROUP_ROLES = ('member', 'editor', 'admin')
+
+
+def restricted_normalize_group_entry(entry):
+    '''Returns an allowed_groups entry as "group:role", the group being a
+    name or id and the role defaulting to member (any member).'''
+    group, _sep, role = entry.strip().partition(':')
+    return '{0}:{1}'.format(group.strip(), role.strip().lower() or 'member')
 
-def restricted_get_restricted_dict(resource_dict):
-    restricted_dict = {'level': 'public', 'allowed_users': []}
+
+class RestrictionPolicy(object):
+    '''Parsed value of the restricted field of a resource.
+
+    `allowed_users` and `allowed_groups` are frozensets for membership
+    tests, the original order is kept in `allowed_users_list` and
+    `allowed_groups_list`. Policies are shared between resources through
+    the compiled policy cache, so treat them as read only.
+    '''
+    __slots__ = ('level', 'allowed_users', 'allowed_users_list',
+                 'allowed_groups', 'allowed_groups_list')
+
+    def __init__(self, level=RestrictionLevel.PUBLIC, allowed_users=(),
+                 allowed_groups=()):
+        self.level = level
+        self.allowed_users_list = tuple(allowed_users)
+        self.allowed_users = frozenset(self.allowed_users_list)
+        self.allowed_groups_list = tuple(
+            restricted_normalize_group_entry(entry)
+            for entry in allowed_groups if entry.strip())
+        self.allowed_groups = frozenset(self.allowed_groups_list)
+
+    @property
+    def is_public(self):
+        return not self.level or self.level == RestrictionLevel.PUBLIC
+
+    def as_dict(self):
+        return {
+            'level': self.level,
+            'allowed_users': list(self.allowed_users_list),
+            'allowed_groups': list(self.allowed_groups_list)}
+
+
+_PUBLIC_POLICY = RestrictionPolicy()
+
+
+def _restricted_split(value):
+    value = value or ''
+    if not isinstance(value, (list, tuple)):
+        value = value.split(',')
+    return value
+
+
+def _restricted_build_policy(restricted):
+    if not restricted or not isinstance(restricted, dict):
+        return _PUBLIC_POLICY
+    return RestrictionPolicy(
+        restricted.get('level', RestrictionLevel.PUBLIC),
+        _restricted_split(restricted.get('allowed_users')),
+        _restricted_split(restricted.get('allowed_groups')))
+
+
+def restricted_compile_policy(restricted):
+    '''Returns the RestrictionPolicy for a raw restricted value.
+
+    The value can be a dict or a JSON string (as stored by composite
+    fields). Policies compiled from strings are memoized by the string.
+    '''
+    if isinstance(restricted, dict):
+        return _restricted_build_policy(restricted)
+    if not restricted:
+        return _PUBLIC_POLICY
+
+    policy = _policy_cache.get(restricted)
+    if policy is None:
+        try:
+            policy = _restricted_build_policy(json.loads(restricted))
+        except (TypeError, ValueError):
+            policy = _PUBLIC_POLICY
+        _policy_cache.set(restricted, policy)
+    return policy
+
+
+def restricted_get_restriction_policy(resource_dict):
+    if not resource_dict:
+        return _PUBLIC_POLICY
 
     # the ckan plugins ckanext-scheming and ckanext-composite
     # change the structure of the resource dict and the nature of how
-    # to access our restricted field values
-    if resource_dict:
-        # the dict might exist as a child inside the extras dict
-        extras = resource_dict.get('extras', {})
-        # or the dict might exist as a direct descendant of the resource dict
-        restricted = resource_dict.get('restricted', extras.get('restricted', {}))
+    # to access our restricted field values:
+    # the dict might exist as a child inside the extras dict
+    # or as a direct descendant of the resource dict
+    extras = resource_dict.get('extras', {})
+    return restricted_compile_policy(
+        resource_dict.get('restricted', extras.get('restricted', {})))
+
+
+def restricted_get_restricted_dict(resource_dict):
+    return restricted_get_restriction_policy(resource_dict).as_dict()
+
+
+def restricted_normalize_restricted(restricted):
+    '''Returns the canonical JSON string of a restricted value: sorted
+    keys, allowed users and groups stripped, without empty or repeated
+    entries. Unknown keys are kept. Values that are not valid JSON objects
+    are returned unchanged.'''
+    if not isinstance(restricted, dict):
+        try:
+            restricted = json.loads(restricted)
+        except (TypeError, ValueError):
+            return restricted
         if not isinstance(restricted, dict):
-            # if the restricted property does exist, but not as a dict,
-            # we may need to parse it as a JSON string to gain access to the values.
-            # as is the case when making composite fields
-            try:
-                restricted = json.loads(restricted)
-            except ValueError:
-                restricted = {}
+            return restricted
+    restricted = dict(restricted)
+    for key in ('allowed_users', 'allowed_groups'):
+        if key in restricted:
+            entries = []
+            for entry in _restricted_split(restricted[key]):
+                entry = entry.strip()
+                if entry and entry not in entries:
+                    entries.append(entry)
+            restricted[key] = ','.join(entries)
+    return json.dumps(restricted, sort_keys=True)
+
+
+def restricted_mask_policy(policy, user_name=''):
+    '''Returns the restricted JSON shown to users who cannot edit the
+    dataset, with the allowed user names partially hidden except the
+    user's own.'''
+    # hide partially other allowed user_names (keep own)
+    allowed_users = []
+    for user in policy.allowed_users_list:
+        if len(user.strip()) > 0:
+            if user_name == user:
+                allowed_users.append(user_name)
+            else:
+                allowed_users.append(user[0:3] + '*****' + user[-2:])
+
+    masked = {
+        'level': policy.level,
+        'allowed_users': ','.join(allowed_users)}
+    # group and organization names are public, they are kept as they are
+    if policy.allowed_groups_list:
+        masked['allowed_groups'] = ','.join(policy.allowed_groups_list)
+    return json.dumps(masked)
+
+
+def restricted_prepare_resource(resource):
+    '''Normalizes the restricted value of a resource being saved, and
+    stores its masked version, for anyone not in the allowed users, in
+    the restricted_masked field.'''
+    restricted = resource.get('restricted')
+    resource.pop('restricted_masked', None)
+    if not restricted:
+        return
+    restricted = restricted_normalize_restricted(restricted)
+    resource['restricted'] = restricted
+    if isinstance(restricted, dict) or restricted.startswith('{'):
+        resource['restricted_masked'] = restricted_mask_policy(
+            restricted_compile_policy(restricted))
 
-        if restricted:
-            restricted_level = restricted.get('level', 'public')
-            allowed_users = restricted.get('allowed_users', '')
-            if not isinstance(allowed_users, list):
-                allowed_users = allowed_users.split(',')
-            restricted_dict = {
-                'level': restricted_level,
-                'allowed_users': allowed_users}
 
-    return restricted_dict
+def restricted_remember_masked(resource_dict):
+    '''Moves the restricted_masked field of a resource being shown to the
+    request memo, where the package_show filter finds it.'''
+    masked = resource_dict.pop('restricted_masked', None)
+    if masked and resource_dict.get('id'):
+        restricted_get_request_memo().setdefault('masked', {})[
+            resource_dict['id']] = masked
 
 
-def restricted_check_user_resource_access(user, resource_dict, package_dict):
-    restricted_dict = restricted_get_restricted_dict(resource_dict)
+def restricted_get_masked_restricted(resource_dict, policy, user_name,
+                                     context=None):
+    '''Returns the masked restricted value of a resource for the user.
 
-    restricted_level = restricted_dict.get('level', 'public')
-    allowed_users = restricted_dict.get('allowed_users', [])
+    The value stored at write time is used unless the user is one of the
+    allowed users, whose own name is shown: only then is it rebuilt.
+    '''
+    if user_name not in policy.allowed_users:
+        masked = resource_dict.get('restricted_masked') or \
+            restricted_get_request_memo(context).get('masked', {}).get(
+                resource_dict.get('id'))
+        if masked:
+            return masked
+    return restricted_mask_policy(policy, user_name)
+
+
+def restricted_check_user_resource_access(
+        user, resource_dict, package_dict, context=None):
+    policy = restricted_get_restriction_policy(resource_dict)
+    restricted_level = policy.level
 
     # Public resources (DEFAULT)
-    if not restricted_level or restricted_level == 'public':
+    if policy.is_public:
         return {'success': True}
 
     # Registered user
@@ -81,28 +653,25 @@ def restricted_check_user_resource_access(user, resource_dict, package_dict):
             'success': False,
             'msg': 'Resource access restricted to registered users'}
     else:
-        if restricted_level == 'registered' or not restricted_level:
+        if restricted_level == RestrictionLevel.REGISTERED:
             return {'success': True}
 
-    # Since we have a user, check if it is in the allowed list
-    if user in allowed_users:
+    # Since we have a user, check if it is in the allowed list, in an
+    # allowed group or has been granted the resource
+    if user in policy.allowed_users or \
+            (policy.allowed_groups and user in
+             restricted_get_allowed_group_members(policy, context)) or \
+            resource_dict.get('id') in restricted_get_user_grants(
+                user, context):
         return {'success': True}
-    elif restricted_level == 'only_allowed_users':
+    elif restricted_level == RestrictionLevel.ONLY_ALLOWED_USERS:
         return {
             'success': False,
             'msg': 'Resource access restricted to allowed users only'}
 
     # Get organization list
-    user_organization_dict = {}
-
-    context = {'user': user}
-    data_dict = {'permission': 'read'}
-
-    for org in logic.get_action('organization_list_for_user')(context, data_dict):
-        name = org.get('name', '')
-        id = org.get('id', '')
-        if name and id:
-            user_organization_dict[id] = name
+    user_organization_dict = restricted_get_user_organization_dict(
+        user, context)
 
     # Any Organization Members (Trusted Users)
     if not user_organization_dict:
@@ -110,13 +679,13 @@ def restricted_check_user_resource_access(user, resource_dict, package_dict):
             'success': False,
             'msg': 'Resource access restricted to members of an organization'}
 
-    if restricted_level == 'any_organization':
+    if restricted_level == RestrictionLevel.ANY_ORGANIZATION:
         return {'success': True}
 
     pkg_organization_id = package_dict.get('owner_org', '')
 
     # Same Organization Members
-    if restricted_level == 'same_organization':
+    if restricted_level == RestrictionLevel.SAME_ORGANIZATION:
         if pkg_organization_id in user_organization_dict.keys():
             return {'success': True}
 
@@ -125,8 +694,170 @@ def restricted_check_user_resource_access(user, resource_dict, package_dict):
         'msg': ('Resource access restricted to same '
                 'organization ({}) members').format(pkg_organization_id)}
 
+def restricted_get_allowed_group_members(policy, context=None):
+    '''Returns the names of the members of the allowed groups of the
+    policy, having at least the role of each entry.
+
+    Expanded with one query and kept for all the policies with the same
+    groups, until a membership changes or the cache TTL expires.
+    '''
+    members = _group_member_cache.get(policy.allowed_groups)
+    if members is not None:
+        return members
+
+    model = (context or {}).get('model')
+    if model is None:
+        import ckan.model as model
+    from sqlalchemy import and_, or_
+
+    stats.count_membership_lookup()
+    conditions = []
+    for entry in policy.allowed_groups:
+        group, role = entry.rsplit(':', 1)
+        roles = GROUP_ROLES[GROUP_ROLES.index(role):] \
+            if role in GROUP_ROLES else (role,)
+        conditions.append(and_(
+            or_(model.Group.name == group, model.Group.id == group),
+            model.Member.capacity.in_(roles)))
+    query = model.Session.query(model.User.name).join(
+        model.Member, model.Member.table_id == model.User.id).join(
+        model.Group, model.Group.id == model.Member.group_id).filter(
+        model.Member.table_name == 'user').filter(
+        model.Member.state == 'active').filter(
+        model.Group.state == 'active').filter(
+        model.User.state == 'active').filter(or_(*conditions))
+
+    members = frozenset(name for name, in query)
+    _group_member_cache.set(policy.allowed_groups, members)
+    return members
+
+
+def restricted_get_user_group_entries(user_name, context=None):
+    '''Returns the allowed_groups entries matching the user, as indexed
+    ("group:role" for the group name and id and every role the user has),
+    loaded once per request.'''
+    entries = restricted_get_request_memo(context).setdefault(
+        'user_group_entries', {})
+    if user_name in entries:
+        return entries[user_name]
+
+    model = (context or {}).get('model')
+    if model is None:
+        import ckan.model as model
+
+    user_entries = set()
+    for name, id, capacity in model.Session.query(
+            model.Group.name, model.Group.id, model.Member.capacity).join(
+            model.Member, model.Member.group_id == model.Group.id).join(
+            model.User, model.User.id == model.Member.table_id).filter(
+            model.Member.table_name == 'user').filter(
+            model.Member.state == 'active').filter(
+            model.Group.state == 'active').filter(
+            model.User.name == user_name):
+        roles = GROUP_ROLES[:GROUP_ROLES.index(capacity) + 1] \
+            if capacity in GROUP_ROLES else (capacity,)
+        for role in roles:
+            user_entries.add('{0}:{1}'.format(name, role))
+            user_entries.add('{0}:{1}'.format(id, role))
+
+    entries[user_name] = user_entries
+    return user_entries
+
+
+def restricted_get_index_token(value):
+    '''Returns the opaque token indexed for an allowed user or group entry.
+
+    vocab_* fields are stored and can be queried by anyone, so user names
+    and group entries are indexed as an HMAC keyed with a server secret.
+    Changing the secret requires rebuilding the search index.
+    '''
+    secret = config.get('ckanext.restricted.index_secret') or \
+        config.get('beaker.session.secret') or ''
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf8')
+    return hmac.new(secret, value.encode('utf8'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def restricted_get_index_fields(resources):
+    '''Returns the Solr fields describing the resources restrictions.
+
+    `vocab_*` fields are indexed as multivalued strings by the CKAN
+    schema, so they can be matched exactly in filter queries. Allowed
+    users and groups are indexed as tokens, see restricted_get_index_token.
+    '''
+    levels = set()
+    allowed_users = set()
+    allowed_groups = set()
+    restricted_ids = []
+    for resource in resources or []:
+        policy = restricted_get_restriction_policy(resource)
+        if policy.is_public:
+            levels.add(RestrictionLevel.PUBLIC)
+        else:
+            levels.add(policy.level)
+            allowed_users.update(user for user in policy.allowed_users if user)
+            allowed_groups.update(policy.allowed_groups)
+            if resource.get('id'):
+                restricted_ids.append(resource['id'])
+    if restricted_ids:
+        from ckanext.restricted import model as restricted_model
+        allowed_users.update(
+            restricted_model.get_user_names_for_resources(restricted_ids))
+    return {
+        'vocab_restricted_levels': sorted(levels),
+        'vocab_restricted_allowed_users': sorted(
+            restricted_get_index_token(user) for user in allowed_users),
+        'vocab_restricted_allowed_groups': sorted(
+            restricted_get_index_token(entry) for entry in allowed_groups)}
+
+
+def _solr_quote(value):
+    return '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def restricted_get_search_fq(user_name, context=None):
+    '''Returns a filter query matching the datasets that have at least
+    one resource the user can access given its restriction level, or
+    None if the user can access everything.'''
+    if context is not None:
+        sysadmin = restricted_get_identity(context)['sysadmin']
+    else:
+        sysadmin = user_name and authz.is_sysadmin(user_name)
+    if sysadmin:
+        return None
+
+    clauses = ['vocab_restricted_levels:{0}'.format(RestrictionLevel.PUBLIC)]
+    if user_name:
+        clauses.append(
+            'vocab_restricted_levels:{0}'.format(RestrictionLevel.REGISTERED))
+        clauses.append(
+            'vocab_restricted_allowed_users:{0}'.format(
+                restricted_get_index_token(user_name)))
+
+        user_group_entries = restricted_get_user_group_entries(
+            user_name, context)
+        if user_group_entries:
+            clauses.append('vocab_restricted_allowed_groups:({0})'.format(
+                ' OR '.join(sorted(restricted_get_index_token(entry)
+                                   for entry in user_group_entries))))
+
+        user_organization_dict = restricted_get_user_organization_dict(
+            user_name, context)
+        if user_organization_dict:
+            clauses.append('vocab_restricted_levels:{0}'.format(
+                RestrictionLevel.ANY_ORGANIZATION))
+            clauses.append('(vocab_restricted_levels:{0} AND owner_org:({1}))'.format(
+                RestrictionLevel.SAME_ORGANIZATION,
+                ' OR '.join(_solr_quote(org_id)
+                            for org_id in sorted(user_organization_dict))))
+
+    return '({0})'.format(' OR '.join(clauses))
+
+
 def restricted_mail_allowed_user(user_id, resource):
     log.debug('restricted_mail_allowed_user: Notifying "{}"'.format(user_id))
+    from ckanext.restricted import mailqueue
     try:
         # Get user information
         context = {}
@@ -143,10 +874,10 @@ def restricted_mail_allowed_user(user_id, resource):
         mail_subject = _('Access granted to resource {}').format(resource_name)
 
         # Send mail to user
-        mailer.mail_recipient(user_name, user_email, mail_subject, mail_body)
+        mailqueue.mail_recipient(user_name, user_email, mail_subject, mail_body)
 
         # Send copy to admin
-        mailer.mail_recipient(
+        mailqueue.mail_recipient(
             'CKAN Admin', config.get('email_to'),
             'Fwd: {}'.format(mail_subject), mail_body)
 
@@ -168,24 +899,165 @@ def restricted_allowed_user_mail_body(user, resource):
         'resource_link': config.get('ckan.site_url') + resource_link,
         'resource_url': resource.get('url')}
 
+    from ckan.lib.base import render_jinja2
     return render_jinja2(
         'restricted/emails/restricted_user_allowed.txt', extra_vars)
 
+
+# rendered once per notification and replaced by every user display name
+_USER_NAME_PLACEHOLDER = '__restricted_user_name__'
+
+
+def restricted_get_users_by_name_or_id(user_ids, context=None):
+    '''Returns the active users matching the given names or ids, loaded
+    with a single query, as {name_or_id: User}.'''
+    if not user_ids:
+        return {}
+    model = (context or {}).get('model')
+    if model is None:
+        import ckan.model as model
+    from sqlalchemy import or_
+
+    user_ids = list(user_ids)
+    users = {}
+    for user in model.Session.query(model.User).filter(
+            model.User.state == 'active').filter(
+            or_(model.User.name.in_(user_ids), model.User.id.in_(user_ids))):
+        users[user.name] = user
+        users[user.id] = user
+    return dict((id, users[id]) for id in user_ids if id in users)
+
+
 def restricted_notify_allowed_users(previous_value, updated_resource):
+    '''Notifies by mail the users added to the allowed users of a resource.
 
-    def _safe_json_loads(json_string, default={}):
-        try:
-            return json.loads(json_string)
-        except Exception:
-            return default
-
-    previous_restricted = _safe_json_loads(previous_value)
-    updated_restricted = _safe_json_loads(updated_resource.get('restricted', ''))
-
-    # compare restricted users_allowed values
-    updated_allowed_users = set(updated_restricted.get('allowed_users', '').split(','))
-    if updated_allowed_users:
-        previous_allowed_users = previous_restricted.get('allowed_users', '').split(',')
-        for user_id in updated_allowed_users:
-            if user_id not in previous_allowed_users:
-                restricted_mail_allowed_user(user_id, updated_resource)
+    The new users are loaded with a single query, the mail body is
+    rendered once and all the mails, plus one digest copy for the admin,
+    are sent over one SMTP connection (or queued, see mailqueue).
+    '''
+    previous_allowed_users = set(
+        user.strip() for user in
+        restricted_compile_policy(previous_value).allowed_users)
+    updated_allowed_users = set(
+        user.strip() for user in
+        restricted_get_restriction_policy(updated_resource).allowed_users)
+
+    new_allowed_users = updated_allowed_users - previous_allowed_users
+    new_allowed_users.discard('')
+    if not new_allowed_users:
+        return
+
+    users = restricted_get_users_by_name_or_id(new_allowed_users)
+    for user_id in new_allowed_users - set(users):
+        log.warning(('restricted_notify_allowed_users: '
+                     'User "{0}" not found').format(user_id))
+
+    try:
+        resource_name = updated_resource.get('name', updated_resource['id'])
+        mail_subject = _('Access granted to resource {}').format(resource_name)
+        mail_body = restricted_allowed_user_mail_body(
+            {'name': _USER_NAME_PLACEHOLDER}, updated_resource)
+
+        messages = []
+        notified = []
+        for user in set(users.values()):
+            if not user.email:
+                log.warning(('restricted_notify_allowed_users: '
+                             'User "{0}" has no email').format(user.name))
+                continue
+            user_name = user.display_name or user.name
+            messages.append({
+                'recipient_name': user_name,
+                'recipient_email': user.email,
+                'subject': mail_subject,
+                'body': mail_body.replace(_USER_NAME_PLACEHOLDER, user_name)})
+            notified.append(user.name)
+
+        if not messages:
+            return
+
+        from ckanext.restricted import mailqueue
+
+        # Send a single copy to admin
+        admin_body = _('Access granted to the users: {0}').format(
+            ', '.join(sorted(notified))) + '\n\n' + mail_body.replace(
+                _USER_NAME_PLACEHOLDER, '[...]')
+        messages.append({
+            'recipient_name': 'CKAN Admin',
+            'recipient_email': config.get('email_to'),
+            'subject': 'Fwd: {}'.format(mail_subject),
+            'body': admin_body})
+
+        mailqueue.mail_recipients(messages)
+
+    except Exception as e:
+        log.warning(('restricted_notify_allowed_users: '
+                     'Failed to notify allowed users of "{0}": {1}').format(
+                         updated_resource.get('id'), e))
+
+
+def restricted_send_access_request_digests():
+    '''Sends every maintainer one mail listing the access requests made
+    to their resources since the last digest, and one mail listing all of
+    them to the admin (email_to).
+
+    :returns: the number of requests and of mails sent
+    '''
+    import datetime
+    import ckan.model as model
+    from ckanext.restricted import mailqueue
+    from ckanext.restricted import model as restricted_model
+    from ckan.lib.base import render_jinja2
+
+    started = datetime.datetime.utcnow()
+    access_requests, ids = restricted_model.get_access_requests_to_notify()
+    if not access_requests:
+        return {'requests': 0, 'mails': 0}
+
+    site_url = config.get('ckan.site_url')
+    for access_request in access_requests:
+        access_request['resource_link'] = \
+            '{0}/dataset/{1}/resource/{2}'.format(
+                site_url, access_request['package_name'],
+                access_request['resource_id'])
+        access_request['resource_edit_link'] = \
+            access_request['resource_link'] + '/edit'
+
+    # one digest per address: the admin gets all the requests, including
+    # those of the datasets without a maintainer email
+    recipients = {}
+    for access_request in access_requests:
+        email = access_request['maintainer_email']
+        if not email:
+            continue
+        recipients.setdefault(email, (
+            access_request['maintainer_name'] or 'Dataset Maintainer',
+            []))[1].append(access_request)
+    if config.get('email_to'):
+        recipients[config.get('email_to')] = ('CKAN Admin', access_requests)
+
+    messages = []
+    for email, (name, recipient_requests) in recipients.items():
+        if not email:
+            continue
+        body = render_jinja2(
+            'restricted/emails/restricted_access_request_digest.txt', {
+                'site_title': config.get('ckan.site_title'),
+                'site_url': site_url,
+                'maintainer_name': name,
+                'admin_email_to': config.get('email_to', 'email_to_undefined'),
+                'access_requests': recipient_requests})
+        messages.append({
+            'recipient_name': name,
+            'recipient_email': email,
+            'subject': _('{0} new access requests on {1}').format(
+                len(recipient_requests), config.get('ckan.site_title')),
+            'body': body})
+
+    mailqueue.mail_recipients(messages)
+
+    # requests repeated while sending are modified after `started` and
+    # included again in the next digest
+    restricted_model.mark_access_requests_notified(ids, started)
+    model.repo.commit()
+    return {'requests': len(access_requests), 'mails': len(messages)}
@@ -0,0 +1,294 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+from email import utils as email_utils
+from email.header import Header
+from email.mime.text import MIMEText
+import json
+import os
+import smtplib
+import socket
+import time
+import uuid
+
+import ckan.plugins.toolkit as toolkit
+
+try:
+    # CKAN 2.7 and later
+    from ckan.common import config
+except ImportError:
+    # CKAN 2.6 and earlier
+    from pylons import config
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+# Maildir like layout: messages are written to 'tmp', moved to 'new' when
+# complete, claimed by a worker by moving them to 'cur' and moved to
+# 'failed' once they run out of attempts. Mails left in 'cur' for longer
+# than the lease timeout, by a worker that died, are moved back to 'new'.
+_SPOOL_FOLDERS = ('tmp', 'new', 'cur', 'failed')
+
+
+def get_spool_dir():
+    return config.get('ckanext.restricted.mail_spool_dir', '')
+
+
+def mail_recipient(recipient_name, recipient_email, subject, body,
+                   headers=None):
+    '''Queues a mail if ckanext.restricted.mail_spool_dir is set, sends it
+    right away with ckan.lib.mailer otherwise.'''
+    if not get_spool_dir():
+        import ckan.lib.mailer as mailer
+        return mailer.mail_recipient(
+            recipient_name, recipient_email, subject, body, headers or {})
+
+    enqueue(recipient_name, recipient_email, subject, body, headers)
+
+
+def mail_recipients(messages):
+    '''Queues or sends several mails at once, over a single SMTP
+    connection when they are sent right away. Mails refused by the server
+    are logged and skipped.
+
+    :param messages: dicts with recipient_name, recipient_email, subject,
+        body and optionally headers
+    '''
+    if get_spool_dir():
+        for message in messages:
+            enqueue(message['recipient_name'], message['recipient_email'],
+                    message['subject'], message['body'],
+                    message.get('headers'))
+        return
+
+    from ckan.lib.mailer import MailerException
+    connection = None
+    try:
+        connection = _smtp_connect()
+        for message in messages:
+            try:
+                _smtp_send(connection, message)
+            except (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPDataError) as e:
+                # the connection can still be used for the next ones
+                log.warning('Mail "{0}" to {1} refused: {2}'.format(
+                    message['subject'], message['recipient_email'], e))
+    except (smtplib.SMTPException, socket.error) as e:
+        raise MailerException('SMTP error sending mails: {0}'.format(e))
+    finally:
+        _smtp_close(connection)
+
+
+def enqueue(recipient_name, recipient_email, subject, body, headers=None):
+    spool_dir = _ensure_spool_dir()
+    message = {
+        'recipient_name': recipient_name,
+        'recipient_email': recipient_email,
+        'subject': subject,
+        'body': body,
+        'headers': headers or {},
+        'created': time.time(),
+        'attempts': 0,
+        'next_attempt': 0}
+    file_name = '{0:.6f}-{1}.json'.format(time.time(), uuid.uuid4().hex)
+    try:
+        _write_message(spool_dir, 'new', file_name, message)
+    except (IOError, OSError) as e:
+        from ckan.lib.mailer import MailerException
+        raise MailerException(
+            'Cannot queue mail to "{0}": {1}'.format(recipient_email, e))
+    log.debug('Queued mail "{0}" to {1}'.format(subject, recipient_email))
+    return file_name
+
+
+def send_queued(max_attempts=None, retry_delay=None, lease_timeout=None):
+    '''Sends the queued mails that are due over a single SMTP connection.
+
+    Failed mails are retried with an exponential backoff starting at
+    `retry_delay` seconds, and moved to the 'failed' folder after
+    `max_attempts`. Mails claimed more than `lease_timeout` seconds ago
+    by a worker that did not finish are queued again first. Returns a dict
+    with the sent, retried, failed and requeued counts.
+    '''
+    from ckan.lib.mailer import MailerException
+
+    if max_attempts is None:
+        max_attempts = toolkit.asint(
+            config.get('ckanext.restricted.mail_max_attempts', 5))
+    if retry_delay is None:
+        retry_delay = toolkit.asint(
+            config.get('ckanext.restricted.mail_retry_delay', 60))
+    if lease_timeout is None:
+        lease_timeout = toolkit.asint(
+            config.get('ckanext.restricted.mail_lease_timeout', 600))
+
+    spool_dir = _ensure_spool_dir()
+    result = {'sent': 0, 'retried': 0, 'failed': 0,
+              'requeued': _requeue_expired(spool_dir, lease_timeout)}
+    connection = None
+
+    try:
+        for file_name in sorted(os.listdir(os.path.join(spool_dir, 'new'))):
+            message = _claim_message(spool_dir, file_name)
+            if message is None:
+                continue
+            if message.get('next_attempt', 0) > time.time():
+                _release_message(spool_dir, file_name, message, 'new')
+                continue
+
+            try:
+                if connection is None:
+                    connection = _smtp_connect()
+                _smtp_send(connection, message)
+            except (smtplib.SMTPException, socket.error,
+                    MailerException) as e:
+                log.warning('Failed to send mail to "{0}": {1}'.format(
+                    message.get('recipient_email'), e))
+                message['attempts'] = message.get('attempts', 0) + 1
+                message['last_error'] = str(e)
+                if message['attempts'] >= max_attempts:
+                    _release_message(spool_dir, file_name, message, 'failed')
+                    result['failed'] += 1
+                else:
+                    message['next_attempt'] = time.time() + \
+                        retry_delay * 2 ** (message['attempts'] - 1)
+                    _release_message(spool_dir, file_name, message, 'new')
+                    result['retried'] += 1
+                # the connection may be broken, open a new one next time
+                connection = _smtp_close(connection)
+                continue
+
+            os.remove(os.path.join(spool_dir, 'cur', file_name))
+            result['sent'] += 1
+    finally:
+        _smtp_close(connection)
+
+    return result
+
+
+def _ensure_spool_dir():
+    spool_dir = get_spool_dir()
+    if not spool_dir:
+        raise ValueError('ckanext.restricted.mail_spool_dir is not set')
+    for folder in _SPOOL_FOLDERS:
+        path = os.path.join(spool_dir, folder)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    return spool_dir
+
+
+def _write_message(spool_dir, folder, file_name, message):
+    tmp_path = os.path.join(spool_dir, 'tmp', file_name)
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(message))
+    os.rename(tmp_path, os.path.join(spool_dir, folder, file_name))
+
+
+def _claim_message(spool_dir, file_name):
+    cur_path = os.path.join(spool_dir, 'cur', file_name)
+    try:
+        os.rename(os.path.join(spool_dir, 'new', file_name), cur_path)
+        # the lease starts now, rename keeps the time of the last write
+        os.utime(cur_path, None)
+    except OSError:
+        # claimed by another worker
+        return None
+    try:
+        with open(cur_path) as f:
+            return json.loads(f.read())
+    except ValueError as e:
+        # never sendable, kept for inspection
+        log.error('Cannot read queued mail {0}: {1}'.format(file_name, e))
+        os.rename(cur_path, os.path.join(spool_dir, 'failed', file_name))
+        return None
+
+
+def _requeue_expired(spool_dir, lease_timeout):
+    '''Moves back to 'new' the mails claimed more than `lease_timeout`
+    seconds ago, left in 'cur' by a worker that died.'''
+    requeued = 0
+    expired = time.time() - lease_timeout
+    cur_dir = os.path.join(spool_dir, 'cur')
+    for file_name in os.listdir(cur_dir):
+        cur_path = os.path.join(cur_dir, file_name)
+        try:
+            if os.path.getmtime(cur_path) > expired:
+                continue
+            os.rename(cur_path, os.path.join(spool_dir, 'new', file_name))
+        except OSError:
+            # sent or requeued by another worker
+            continue
+        log.warning('Queued again mail {0}, claimed {1}s ago'.format(
+            file_name, lease_timeout))
+        requeued += 1
+    return requeued
+
+
+def _release_message(spool_dir, file_name, message, folder):
+    _write_message(spool_dir, folder, file_name, message)
+    os.remove(os.path.join(spool_dir, 'cur', file_name))
+
+
+def _smtp_connect():
+    # same connection setup as ckan.lib.mailer
+    from ckan.lib.mailer import MailerException
+
+    if 'smtp.test_server' in config:
+        # tests, the smtp.server, starttls and credentials are not used
+        smtp_server = config['smtp.test_server']
+        smtp_starttls = False
+        smtp_user = None
+        smtp_password = None
+    else:
+        smtp_server = config.get('smtp.server', 'localhost')
+        smtp_starttls = toolkit.asbool(config.get('smtp.starttls'))
+        smtp_user = config.get('smtp.user')
+        smtp_password = config.get('smtp.password')
+
+    connection = smtplib.SMTP()
+    connection.connect(smtp_server)
+    try:
+        connection.ehlo()
+        if smtp_starttls:
+            if not connection.has_extn('STARTTLS'):
+                raise MailerException('SMTP server does not support STARTTLS')
+            connection.starttls()
+            connection.ehlo()
+        if smtp_user:
+            if not smtp_password:
+                raise MailerException('If smtp.user is configured then '
+                                      'smtp.password must be configured '
+                                      'as well.')
+            connection.login(smtp_user, smtp_password)
+    except Exception:
+        _smtp_close(connection)
+        raise
+    return connection
+
+
+def _smtp_close(connection):
+    if connection is not None:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+    return None
+
+
+def _smtp_send(connection, message):
+    # same message format as ckan.lib.mailer
+    mail_from = config.get('smtp.mail_from')
+    msg = MIMEText(message['body'], 'plain', 'utf-8')
+    for key, value in message.get('headers', {}).items():
+        msg[key] = value
+    msg['Subject'] = Header(message['subject'], 'utf-8')
+    msg['From'] = '{0} <{1}>'.format(
+        config.get('ckan.site_title'), mail_from)
+    msg['To'] = Header('{0} <{1}>'.format(
+        message['recipient_name'], message['recipient_email']), 'utf-8')
+    msg['Date'] = email_utils.formatdate(time.time())
+    msg['X-Mailer'] = 'ckanext-restricted'
+
+    connection.sendmail(
+        mail_from, [message['recipient_email']], msg.as_string())
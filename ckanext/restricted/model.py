@@ -0,0 +1,393 @@
+# coding: utf8
+'''Tables of the extension.
+
+restricted_grant has one row per user allowed on a resource. Rows come
+from two sources. `metadata` rows mirror the allowed_users of
+the resource `restricted` field and are kept in sync when resources are
+created or updated. `action` rows are added and removed with the
+restricted_grant_access and restricted_revoke_access actions, so large
+allow-lists do not have to live in the resource metadata.
+
+restricted_access_request keeps the access requests sent with the request
+form. Repeated requests of a user for a resource are merged into its
+pending row, and maintainers are notified by periodic digests.
+'''
+
+from __future__ import unicode_literals
+import datetime
+import uuid
+
+from sqlalchemy import Column, ForeignKey, Index, Table, types
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+import ckan.model as model
+from ckan.model import domain_object
+from ckan.model import meta
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+SOURCE_METADATA = 'metadata'
+SOURCE_ACTION = 'action'
+
+# rows inserted or deleted per statement
+BATCH_SIZE = 1000
+
+restricted_grant_table = Table(
+    'restricted_grant', meta.metadata,
+    Column('resource_id', types.UnicodeText,
+           ForeignKey('resource.id', ondelete='CASCADE'), primary_key=True),
+    Column('user_id', types.UnicodeText,
+           ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+    Column('source', types.UnicodeText, primary_key=True),
+    Column('granted_at', types.DateTime, nullable=False,
+           default=datetime.datetime.utcnow),
+    Column('granted_by', types.UnicodeText, nullable=True),
+    Index('idx_restricted_grant_resource_id', 'resource_id'),
+    Index('idx_restricted_grant_user_id', 'user_id'),
+)
+
+
+STATUS_PENDING = 'pending'
+
+restricted_access_request_table = Table(
+    'restricted_access_request', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True,
+           default=lambda: uuid.uuid4().hex),
+    Column('resource_id', types.UnicodeText,
+           ForeignKey('resource.id', ondelete='CASCADE'), nullable=False),
+    Column('package_id', types.UnicodeText,
+           ForeignKey('package.id', ondelete='CASCADE'), nullable=False),
+    Column('user_id', types.UnicodeText,
+           ForeignKey('user.id', ondelete='CASCADE'), nullable=False),
+    Column('status', types.UnicodeText, nullable=False,
+           default=STATUS_PENDING),
+    Column('message', types.UnicodeText),
+    Column('maintainer_name', types.UnicodeText),
+    Column('maintainer_email', types.UnicodeText),
+    Column('request_count', types.Integer, nullable=False, default=1),
+    Column('created', types.DateTime, nullable=False,
+           default=datetime.datetime.utcnow),
+    Column('modified', types.DateTime, nullable=False,
+           default=datetime.datetime.utcnow),
+    Column('notified', types.DateTime, nullable=True),
+    Index('idx_restricted_access_request_key',
+          'resource_id', 'user_id', 'status', unique=True),
+    Index('idx_restricted_access_request_package_id', 'package_id'),
+    Index('idx_restricted_access_request_user_id', 'user_id'),
+    Index('idx_restricted_access_request_status_modified',
+          'status', 'modified'),
+)
+
+
+class RestrictedGrant(domain_object.DomainObject):
+    pass
+
+
+class RestrictedAccessRequest(domain_object.DomainObject):
+    pass
+
+
+meta.mapper(RestrictedGrant, restricted_grant_table)
+meta.mapper(RestrictedAccessRequest, restricted_access_request_table)
+
+
+def setup():
+    '''Creates the tables of the extension, once the CKAN tables exist.'''
+    if not model.resource_table.exists():
+        log.debug('CKAN tables not created yet, restricted tables skipped')
+        return
+    for table in (restricted_grant_table, restricted_access_request_table):
+        if not table.exists():
+            table.create()
+            log.info('{0} table created'.format(table.name))
+
+
+def get_resource_ids_for_user(user_name, source=None):
+    '''Returns the ids of the resources the user has been granted.'''
+    query = model.Session.query(RestrictedGrant.resource_id).join(
+        model.User, model.User.id == RestrictedGrant.user_id).filter(
+        model.User.name == user_name)
+    if source:
+        query = query.filter(RestrictedGrant.source == source)
+    return frozenset(resource_id for resource_id, in query)
+
+
+def get_user_names_for_resources(resource_ids):
+    '''Returns the names of the users granted any of the resources.'''
+    if not resource_ids:
+        return set()
+    query = model.Session.query(model.User.name).join(
+        RestrictedGrant, model.User.id == RestrictedGrant.user_id).filter(
+        RestrictedGrant.resource_id.in_(list(resource_ids))).distinct()
+    return set(name for name, in query)
+
+
+def get_grants(resource_id=None, user_id=None, limit=None, offset=0):
+    '''Returns the grants of a resource or a user, oldest first, as
+    (grant dicts, total count).'''
+    query = model.Session.query(RestrictedGrant, model.User.name).join(
+        model.User, model.User.id == RestrictedGrant.user_id)
+    if resource_id:
+        query = query.filter(RestrictedGrant.resource_id == resource_id)
+    if user_id:
+        query = query.filter(RestrictedGrant.user_id == user_id)
+
+    count = query.count()
+    query = query.order_by(
+        RestrictedGrant.granted_at, RestrictedGrant.resource_id,
+        RestrictedGrant.user_id).offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return [{
+        'resource_id': grant.resource_id,
+        'user_id': grant.user_id,
+        'user_name': user_name,
+        'source': grant.source,
+        'granted_at': grant.granted_at.isoformat(),
+        'granted_by': grant.granted_by,
+    } for grant, user_name in query], count
+
+
+def grant(resource_id, user_ids, granted_by=None, source=SOURCE_ACTION):
+    '''Adds the grants of the users missing one from this source, and
+    returns the ids of the users added. Does not commit.'''
+    user_ids = set(user_ids)
+    if not user_ids:
+        return []
+    existing = set(user_id for user_id, in model.Session.query(
+        RestrictedGrant.user_id).filter(
+        RestrictedGrant.resource_id == resource_id).filter(
+        RestrictedGrant.source == source))
+    added = sorted(user_ids - existing)
+    now = datetime.datetime.utcnow()
+    for start in range(0, len(added), BATCH_SIZE):
+        model.Session.execute(restricted_grant_table.insert(), [{
+            'resource_id': resource_id,
+            'user_id': user_id,
+            'source': source,
+            'granted_at': now,
+            'granted_by': granted_by,
+        } for user_id in added[start:start + BATCH_SIZE]])
+    return added
+
+
+def revoke(resource_id, user_ids, source=None):
+    '''Deletes the grants of the users, from one source or all of them,
+    and returns the number of rows deleted. Does not commit.'''
+    user_ids = list(set(user_ids))
+    deleted = 0
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        condition = and_(
+            restricted_grant_table.c.resource_id == resource_id,
+            restricted_grant_table.c.user_id.in_(
+                user_ids[start:start + BATCH_SIZE]))
+        if source:
+            condition = and_(
+                condition, restricted_grant_table.c.source == source)
+        deleted += model.Session.execute(
+            restricted_grant_table.delete().where(condition)).rowcount
+    return deleted
+
+
+def sync_metadata_grants(resource_user_ids, granted_by=None):
+    '''Makes the metadata grants of the resources match
+    {resource id: set of allowed user ids}. Does not commit.'''
+    if not resource_user_ids:
+        return
+    existing = {}
+    for resource_id, user_id in model.Session.query(
+            RestrictedGrant.resource_id, RestrictedGrant.user_id).filter(
+            RestrictedGrant.resource_id.in_(list(resource_user_ids))).filter(
+            RestrictedGrant.source == SOURCE_METADATA):
+        existing.setdefault(resource_id, set()).add(user_id)
+
+    for resource_id, user_ids in resource_user_ids.items():
+        current = existing.get(resource_id, set())
+        if current - user_ids:
+            revoke(resource_id, current - user_ids, source=SOURCE_METADATA)
+        if user_ids - current:
+            grant(resource_id, user_ids - current, granted_by,
+                  source=SOURCE_METADATA)
+
+
+def iter_restricted_resources(batch_size=BATCH_SIZE):
+    '''Yields (resource id, restricted value) of the active resources
+    that have one, loading them in batches.'''
+    query = model.Session.query(
+        model.Resource.id, model.Resource.extras).filter(
+        model.Resource.state == 'active')
+    for resource_id, extras in query.yield_per(batch_size):
+        if extras and extras.get('restricted'):
+            yield resource_id, extras['restricted']
+
+
+def get_resources_to_restrict(organization_id=None, dataset_pattern=None,
+                              ids=None):
+    '''Returns (resource id, package id) of the active resources of the
+    active datasets matching all the given selectors: an organization id,
+    a dataset name pattern (* is a wildcard) and resource or dataset ids.
+    '''
+    query = model.Session.query(
+        model.Resource.id, model.Resource.package_id).join(
+        model.Package, model.Package.id == model.Resource.package_id).filter(
+        model.Resource.state == 'active').filter(
+        model.Package.state == 'active')
+    if organization_id:
+        query = query.filter(model.Package.owner_org == organization_id)
+    if dataset_pattern:
+        query = query.filter(model.Package.name.like(
+            dataset_pattern.replace('%', '\\%').replace('_', '\\_')
+            .replace('*', '%'), escape='\\'))
+    query = query.order_by(model.Resource.package_id, model.Resource.id)
+    if ids is None:
+        return query.all()
+
+    ids = list(ids)
+    rows = set()
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start + BATCH_SIZE]
+        rows.update(query.filter(or_(
+            model.Resource.id.in_(batch), model.Package.id.in_(batch),
+            model.Package.name.in_(batch))).all())
+    return sorted(rows, key=lambda row: (row[1], row[0]))
+
+
+def _get_pending_access_request(resource_id, user_id):
+    return model.Session.query(RestrictedAccessRequest).filter(
+        RestrictedAccessRequest.resource_id == resource_id).filter(
+        RestrictedAccessRequest.user_id == user_id).filter(
+        RestrictedAccessRequest.status == STATUS_PENDING).first()
+
+
+def save_access_request(resource_id, package_id, user_id, message,
+                        maintainer_name=None, maintainer_email=None):
+    '''Saves an access request, merged into the pending request of the
+    user for the resource if there is one. Returns the request, with
+    request_count > 1 if merged. Does not commit.
+
+    Concurrent requests (e.g. a double click) are merged too: the insert
+    is made in a savepoint, and the row inserted first is updated if it
+    violates the unique (resource_id, user_id, status) index.
+    '''
+    now = datetime.datetime.utcnow()
+    access_request = _get_pending_access_request(resource_id, user_id)
+    if access_request is None:
+        access_request = RestrictedAccessRequest()
+        access_request.resource_id = resource_id
+        access_request.package_id = package_id
+        access_request.user_id = user_id
+        access_request.status = STATUS_PENDING
+        access_request.request_count = 1
+        access_request.created = now
+        access_request.message = message
+        access_request.maintainer_name = maintainer_name
+        access_request.maintainer_email = maintainer_email
+        access_request.modified = now
+        savepoint = model.Session.begin_nested()
+        try:
+            model.Session.add(access_request)
+            savepoint.commit()
+            return access_request
+        except IntegrityError:
+            savepoint.rollback()
+            access_request = _get_pending_access_request(resource_id, user_id)
+            if access_request is None:
+                raise
+
+    # incremented by the database, concurrent requests are all counted
+    access_request.request_count = RestrictedAccessRequest.request_count + 1
+    access_request.message = message
+    access_request.maintainer_name = maintainer_name
+    access_request.maintainer_email = maintainer_email
+    access_request.modified = now
+    model.Session.flush()
+    return access_request
+
+
+def get_access_requests(package_id=None, resource_id=None, user_id=None,
+                        status=None, limit=None, offset=0):
+    '''Returns the matching access requests, most recent first, as
+    (request dicts, total count).'''
+    query = model.Session.query(
+        RestrictedAccessRequest, model.User.name, model.Resource.name,
+        model.Package.name).join(
+        model.User, model.User.id == RestrictedAccessRequest.user_id).join(
+        model.Resource,
+        model.Resource.id == RestrictedAccessRequest.resource_id).join(
+        model.Package, model.Package.id == RestrictedAccessRequest.package_id)
+    if package_id:
+        query = query.filter(RestrictedAccessRequest.package_id == package_id)
+    if resource_id:
+        query = query.filter(
+            RestrictedAccessRequest.resource_id == resource_id)
+    if user_id:
+        query = query.filter(RestrictedAccessRequest.user_id == user_id)
+    if status:
+        query = query.filter(RestrictedAccessRequest.status == status)
+
+    count = query.count()
+    query = query.order_by(
+        RestrictedAccessRequest.modified.desc(),
+        RestrictedAccessRequest.id).offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return [_access_request_dictize(*row) for row in query], count
+
+
+def get_access_requests_to_notify():
+    '''Returns the pending access requests not included in a digest since
+    they were last made, as (request dicts, ids).'''
+    query = model.Session.query(
+        RestrictedAccessRequest, model.User.name, model.Resource.name,
+        model.Package.name).join(
+        model.User, model.User.id == RestrictedAccessRequest.user_id).join(
+        model.Resource,
+        model.Resource.id == RestrictedAccessRequest.resource_id).join(
+        model.Package,
+        model.Package.id == RestrictedAccessRequest.package_id).filter(
+        RestrictedAccessRequest.status == STATUS_PENDING).filter(
+        or_(RestrictedAccessRequest.notified == None,  # noqa: E711
+            RestrictedAccessRequest.notified <
+            RestrictedAccessRequest.modified)).order_by(
+        RestrictedAccessRequest.package_id,
+        RestrictedAccessRequest.modified)
+    rows = query.all()
+    return ([_access_request_dictize(*row) for row in rows],
+            [row[0].id for row in rows])
+
+
+def mark_access_requests_notified(ids, notified=None):
+    '''Records that the requests were included in a digest. Does not
+    commit.'''
+    notified = notified or datetime.datetime.utcnow()
+    ids = list(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        model.Session.execute(
+            restricted_access_request_table.update().where(
+                restricted_access_request_table.c.id.in_(
+                    ids[start:start + BATCH_SIZE])).values(notified=notified))
+
+
+def _access_request_dictize(access_request, user_name, resource_name,
+                            package_name):
+    return {
+        'id': access_request.id,
+        'resource_id': access_request.resource_id,
+        'resource_name': resource_name,
+        'package_id': access_request.package_id,
+        'package_name': package_name,
+        'user_id': access_request.user_id,
+        'user_name': user_name,
+        'status': access_request.status,
+        'message': access_request.message,
+        'maintainer_name': access_request.maintainer_name,
+        'maintainer_email': access_request.maintainer_email,
+        'request_count': access_request.request_count,
+        'created': access_request.created.isoformat(),
+        'modified': access_request.modified.isoformat(),
+        'notified': access_request.notified.isoformat()
+        if access_request.notified else None,
+    }
@@ -9,6 +9,8 @@ from ckanext.restricted import action
 from ckanext.restricted import auth
 from ckanext.restricted import helpers
 from ckanext.restricted import logic
+from ckanext.restricted import stats
+import json
 
 from logging import getLogger
 log = getLogger(__name__)
@@ -20,11 +22,13 @@ _get_or_bust = ckan.logic.get_or_bust
 class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.ITranslation)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
 
     # IConfigurer
     def update_config(self, config_):
@@ -32,23 +36,56 @@ class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'restricted')
 
+    # IConfigurable
+    def configure(self, config_):
+        logic.restricted_configure_caches(config_)
+        stats.configure(config_)
+
+        from ckanext.restricted import model as restricted_model
+        restricted_model.setup()
+
     # IActions
     def get_actions(self):
-        return {'user_create': action.restricted_user_create_and_notify,
-                'resource_view_list': action.restricted_resource_view_list,
-                'package_show': action.restricted_package_show,
-                'resource_search': action.restricted_resource_search,
-                'package_search': action.restricted_package_search,
-                'restricted_check_access': action.restricted_check_access }
+        return stats.instrument_functions('action', {
+            'user_create': action.restricted_user_create_and_notify,
+            'user_delete': action.restricted_user_delete,
+            'member_create': action.restricted_member_create,
+            'member_delete': action.restricted_member_delete,
+            'organization_member_create':
+                action.restricted_organization_member_create,
+            'organization_member_delete':
+                action.restricted_organization_member_delete,
+            'resource_view_list': action.restricted_resource_view_list,
+            'package_show': action.restricted_package_show,
+            'resource_search': action.restricted_resource_search,
+            'package_search': action.restricted_package_search,
+            'restricted_check_access': action.restricted_check_access,
+            'restricted_check_access_batch':
+                action.restricted_check_access_batch,
+            'restricted_grant_access': action.restricted_grant_access,
+            'restricted_revoke_access': action.restricted_revoke_access,
+            'restricted_grant_list': action.restricted_grant_list,
+            'restricted_access_request_list':
+                action.restricted_access_request_list,
+            'restricted_stats': action.restricted_stats})
 
     # ITemplateHelpers
     def get_helpers(self):
-        return {'restricted_get_user_id': helpers.restricted_get_user_id}
+        return {'restricted_get_user_id': helpers.restricted_get_user_id,
+                'restricted_get_resources_access':
+                    helpers.restricted_get_resources_access}
 
     # IAuthFunctions
     def get_auth_functions(self):
-        return {'resource_show': auth.restricted_resource_show,
-                'resource_view_show': auth.restricted_resource_show}
+        return stats.instrument_functions('auth', {
+            'resource_show': auth.restricted_resource_show,
+            'resource_view_show': auth.restricted_resource_show,
+            'restricted_grant_access': auth.restricted_grant_access,
+            'restricted_revoke_access': auth.restricted_revoke_access,
+            'restricted_grant_list': auth.restricted_grant_list,
+            'restricted_access_request_list':
+                auth.restricted_access_request_list,
+            'restricted_stats': auth.restricted_stats})
 
     # IRoutes
     def before_map(self, map_):
@@ -60,9 +97,54 @@ class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
         return map_
 
     # IResourceController
+    def before_create(self, context, resource):
+        logic.restricted_prepare_resource(resource)
+
     def before_update(self, context, current, resource):
         context['__restricted_previous_value'] = current.get('restricted')
+        logic.restricted_prepare_resource(resource)
+
+    def before_show(self, resource_dict):
+        logic.restricted_remember_masked(resource_dict)
+        return resource_dict
+
+    # IResourceController and IPackageController
+    def after_create(self, context, resource):
+        # IPackageController gets the dataset dict, where resources created
+        # with the dataset have no id yet: those are synced on their next
+        # update, or by the migrate-grants command
+        if 'package_id' in resource:
+            # resource_create calls this once committed, unlike the
+            # dataset hooks, which are committed with their action
+            logic.restricted_sync_grants(context, [resource])
+            if not context.get('defer_commit'):
+                context['model'].repo.commit()
+        else:
+            logic.restricted_sync_grants(
+                context, resource.get('resources', []))
 
     def after_update(self, context, resource):
-        previous_value = context.get('__restricted_previous_value')
-        # logic.restricted_notify_allowed_users(previous_value, resource)
+        # IPackageController.after_update is called with the dataset dict,
+        # also during a resource update. Only resource dicts have package_id
+        if 'package_id' not in resource:
+            logic.restricted_invalidate_package(resource.get('id'))
+            logic.restricted_sync_grants(
+                context, resource.get('resources', []))
+            return
+        if '__restricted_previous_value' not in context:
+            return
+        previous_value = context.pop('__restricted_previous_value')
+        logic.restricted_notify_allowed_users(previous_value, resource)
+
+    # IPackageController
+    def after_delete(self, context, pkg_dict):
+        # IResourceController.after_delete gets the list of resources left
+        if isinstance(pkg_dict, dict):
+            logic.restricted_invalidate_package(pkg_dict.get('id'))
+
+    def before_index(self, pkg_dict):
+        validated_data_dict = pkg_dict.get('validated_data_dict')
+        if validated_data_dict:
+            pkg_dict.update(logic.restricted_get_index_fields(
+                json.loads(validated_data_dict).get('resources', [])))
+        return pkg_dict
@@ -0,0 +1,241 @@
+# coding: utf8
+'''Access matrix report: which users can access which restricted resources.
+
+Memberships, users and grants are loaded once into in-memory indexes and
+the resources are streamed, so the access of all the users to a resource
+is computed with set operations and written out before the next resource
+is loaded. Memory use depends on the number of users and memberships, not
+on the size of the matrix.
+'''
+
+from __future__ import unicode_literals
+import csv
+import json
+import sys
+
+import ckan.model as model
+from ckanext.restricted import logic
+from ckanext.restricted import model as restricted_model
+
+
+FIELDS = ('resource_id', 'package_id', 'level', 'user_id', 'user_name',
+          'access', 'reason')
+
+# every registered user, when they are not listed one by one
+ALL_USERS = '*'
+
+_EDITOR_ROLES = ('editor', 'admin')
+
+
+class _Indexes(object):
+    '''Users, memberships and grants, loaded with one query each.'''
+
+    def __init__(self):
+        self.user_names = {}
+        self.user_ids = {}
+        self.sysadmins = set()
+        for id, name, sysadmin in model.Session.query(
+                model.User.id, model.User.name, model.User.sysadmin).filter(
+                model.User.state == 'active').yield_per(
+                restricted_model.BATCH_SIZE):
+            self.user_names[id] = name
+            self.user_ids[name] = id
+            if sysadmin:
+                self.sysadmins.add(id)
+
+        # group id -> {user id: capacity}, names and ids -> group id
+        self.group_members = {}
+        self.group_ids = {}
+        self.organization_members = set()
+        for user_id, group_id, group_name, is_organization, capacity in \
+                model.Session.query(
+                    model.Member.table_id, model.Group.id, model.Group.name,
+                    model.Group.is_organization, model.Member.capacity).join(
+                    model.Group, model.Group.id == model.Member.group_id).filter(
+                    model.Member.table_name == 'user').filter(
+                    model.Member.state == 'active').filter(
+                    model.Group.state == 'active').yield_per(
+                    restricted_model.BATCH_SIZE):
+            if user_id not in self.user_names:
+                continue
+            self.group_members.setdefault(group_id, {})[user_id] = capacity
+            self.group_ids[group_id] = group_id
+            self.group_ids[group_name] = group_id
+            if is_organization:
+                self.organization_members.add(user_id)
+
+        # resource id -> user ids granted with restricted_grant_access
+        self.grants = {}
+        for resource_id, user_id in model.Session.query(
+                restricted_model.RestrictedGrant.resource_id,
+                restricted_model.RestrictedGrant.user_id).filter(
+                restricted_model.RestrictedGrant.source ==
+                restricted_model.SOURCE_ACTION).yield_per(
+                restricted_model.BATCH_SIZE):
+            self.grants.setdefault(resource_id, set()).add(user_id)
+
+        self._allowed_groups = {}
+
+    def members(self, group_id, roles=None):
+        members = self.group_members.get(group_id, {})
+        if roles is None:
+            return set(members)
+        return set(user for user, capacity in members.items()
+                   if capacity in roles)
+
+    def allowed_group_members(self, policy):
+        '''Expands the allowed groups of a policy, once per distinct list.'''
+        members = self._allowed_groups.get(policy.allowed_groups)
+        if members is None:
+            members = set()
+            for entry in policy.allowed_groups:
+                group, role = entry.rsplit(':', 1)
+                roles = logic.GROUP_ROLES[logic.GROUP_ROLES.index(role):] \
+                    if role in logic.GROUP_ROLES else (role,)
+                group_id = self.group_ids.get(group)
+                if group_id:
+                    members |= self.members(group_id, roles)
+            members = frozenset(members)
+            self._allowed_groups[policy.allowed_groups] = members
+        return members
+
+
+def _iter_resources():
+    '''Yields the active resources that are restricted or in a private
+    dataset, with their dataset organization and private flag.'''
+    query = model.Session.query(
+        model.Resource.id, model.Resource.package_id, model.Resource.extras,
+        model.Package.owner_org, model.Package.private).join(
+        model.Package, model.Package.id == model.Resource.package_id).filter(
+        model.Resource.state == 'active').filter(
+        model.Package.state == 'active').order_by(
+        model.Resource.package_id, model.Resource.id)
+    for resource_id, package_id, extras, owner_org, private in \
+            query.yield_per(restricted_model.BATCH_SIZE):
+        policy = logic.restricted_compile_policy(
+            (extras or {}).get('restricted'))
+        if policy.is_public and not private:
+            continue
+        yield resource_id, package_id, owner_org, private, policy
+
+
+def iter_access_matrix(include_denied=False, expand_registered=False):
+    '''Yields a row per user and resource with the effective access,
+    following restricted_check_user_resource_access and the dataset edit
+    and read permissions, with the reason of the decision.
+
+    Resources open to every registered user get a single ALL_USERS row
+    unless `expand_registered`. Denied rows are only yielded with
+    `include_denied`.
+    '''
+    indexes = _Indexes()
+    all_users = set(indexes.user_names)
+
+    for resource_id, package_id, owner_org, private, policy in \
+            _iter_resources():
+        level = logic.RestrictionLevel.PUBLIC if policy.is_public \
+            else policy.level
+        organization_members = indexes.members(owner_org) \
+            if owner_org else set()
+
+        # the most specific reason is kept
+        reasons = {}
+        for user_id in indexes.sysadmins:
+            reasons[user_id] = 'sysadmin'
+        if owner_org:
+            for user_id in indexes.members(owner_org, _EDITOR_ROLES):
+                reasons.setdefault(user_id, 'editor')
+
+        granted = {}
+        # compared as restricted_check_user_resource_access does, legacy
+        # values saved with spaces around the commas do not match
+        for name in policy.allowed_users:
+            user_id = indexes.user_ids.get(name)
+            if user_id:
+                granted.setdefault(user_id, 'allowed_user')
+        if policy.allowed_groups:
+            for user_id in indexes.allowed_group_members(policy):
+                granted.setdefault(user_id, 'allowed_group')
+        for user_id in indexes.grants.get(resource_id, ()):
+            granted.setdefault(user_id, 'grant')
+
+        everyone = False
+        if level in (logic.RestrictionLevel.PUBLIC,
+                     logic.RestrictionLevel.REGISTERED):
+            everyone = True
+        elif level == logic.RestrictionLevel.ANY_ORGANIZATION:
+            for user_id in indexes.organization_members:
+                granted.setdefault(user_id, level)
+        elif level == logic.RestrictionLevel.SAME_ORGANIZATION:
+            for user_id in organization_members:
+                granted.setdefault(user_id, level)
+
+        # only the organization members can read a private dataset
+        if private:
+            if everyone:
+                for user_id in organization_members:
+                    granted.setdefault(user_id, level)
+                everyone = False
+            granted = dict(
+                (user_id, reason) for user_id, reason in granted.items()
+                if user_id in organization_members)
+        for user_id, reason in granted.items():
+            reasons.setdefault(user_id, reason)
+
+        if everyone and not expand_registered:
+            yield _row(resource_id, package_id, level, ALL_USERS, ALL_USERS,
+                       True, level)
+            for user_id in sorted(reasons):
+                yield _row(resource_id, package_id, level, user_id,
+                           indexes.user_names[user_id], True,
+                           reasons[user_id])
+            continue
+        if everyone:
+            for user_id in all_users:
+                reasons.setdefault(user_id, level)
+
+        for user_id in sorted(reasons):
+            yield _row(resource_id, package_id, level, user_id,
+                       indexes.user_names[user_id], True, reasons[user_id])
+        if include_denied:
+            denied_reason = 'private_dataset' if private else level
+            for user_id in sorted(all_users - set(reasons)):
+                yield _row(resource_id, package_id, level, user_id,
+                           indexes.user_names[user_id], False, denied_reason)
+
+
+def _row(resource_id, package_id, level, user_id, user_name, access, reason):
+    return {
+        'resource_id': resource_id,
+        'package_id': package_id,
+        'level': level,
+        'user_id': user_id,
+        'user_name': user_name,
+        'access': access,
+        'reason': reason}
+
+
+def write_csv(rows, output):
+    writer = csv.writer(output)
+    writer.writerow(FIELDS)
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(row[field]) for field in FIELDS])
+        count += 1
+    return count
+
+
+def write_jsonl(rows, output):
+    count = 0
+    for row in rows:
+        output.write(json.dumps(row) + '\n')
+        count += 1
+    return count
+
+
+def _csv_value(value):
+    if value is True or value is False:
+        value = 'true' if value else 'false'
+    if sys.version_info[0] < 3:
+        return value.encode('utf8')
+    return value
@@ -0,0 +1,136 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+import functools
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+_enabled = [False]
+_stats = {}
+_stats_lock = threading.Lock()
+
+# stack of the instrumented calls running in this thread, SQL statements
+# and membership lookups are counted in all of them
+_local = threading.local()
+
+
+def configure(config_):
+    _enabled[0] = toolkit.asbool(
+        config_.get('ckanext.restricted.stats_enabled', False))
+    if _enabled[0]:
+        _listen_sql_statements()
+
+
+def is_enabled():
+    return _enabled[0]
+
+
+def instrument_functions(kind, functions):
+    '''Returns the functions wrapped to record their stats, or unchanged
+    if the stats are disabled so they add no overhead.'''
+    if not _enabled[0]:
+        return functions
+    return dict(
+        (name, _instrument('{0}:{1}'.format(kind, name), function))
+        for name, function in functions.items())
+
+
+def count_membership_lookup():
+    for frame in getattr(_local, 'frames', ()):
+        frame['membership_lookups'] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(
+            (name, {
+                'calls': entry['calls'],
+                'errors': entry['errors'],
+                'total_seconds': entry['total_seconds'],
+                'latency_histogram': [
+                    [bound, count] for bound, count in zip(
+                        LATENCY_BUCKETS + ('inf',), entry['histogram'])],
+                'sql_statements': entry['sql_statements'],
+                'membership_lookups': entry['membership_lookups']})
+            for name, entry in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _instrument(name, function):
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        frames = getattr(_local, 'frames', None)
+        if frames is None:
+            frames = _local.frames = []
+        frame = {'sql_statements': 0, 'membership_lookups': 0}
+        frames.append(frame)
+        error = False
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            frames.pop()
+            _record(name, elapsed, error, frame)
+
+    return wrapper
+
+
+def _record(name, elapsed, error, frame):
+    with _stats_lock:
+        entry = _stats.get(name)
+        if entry is None:
+            entry = _stats[name] = {
+                'calls': 0, 'errors': 0, 'total_seconds': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+                'sql_statements': 0, 'membership_lookups': 0}
+        entry['calls'] += 1
+        entry['errors'] += 1 if error else 0
+        entry['total_seconds'] += elapsed
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                break
+        else:
+            index = len(LATENCY_BUCKETS)
+        entry['histogram'][index] += 1
+        entry['sql_statements'] += frame['sql_statements']
+        entry['membership_lookups'] += frame['membership_lookups']
+
+
+_sql_listener_installed = [False]
+
+
+def _listen_sql_statements():
+    if _sql_listener_installed[0]:
+        return
+    try:
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+    except ImportError:
+        log.warning('SQLAlchemy not available, SQL statements not counted')
+        return
+    event.listen(Engine, 'before_cursor_execute', _count_sql_statement)
+    _sql_listener_installed[0] = True
+
+
+def _count_sql_statement(conn, cursor, statement, parameters, context,
+                         executemany):
+    for frame in getattr(_local, 'frames', ()):
+        frame['sql_statements'] += 1
@@ -0,0 +1,117 @@
+"""Tests for the stored access requests and their digests."""
+import mock
+import nose.tools
+
+import ckan.model as model
+import ckan.plugins as plugins
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.restricted import logic
+from ckanext.restricted import mailqueue
+from ckanext.restricted import model as restricted_model
+
+assert_equals = nose.tools.assert_equals
+
+
+class TestAccessRequests(object):
+
+    @classmethod
+    def setup_class(cls):
+        if not plugins.plugin_loaded('restricted'):
+            plugins.load('restricted')
+
+    @classmethod
+    def teardown_class(cls):
+        plugins.unload('restricted')
+
+    def setup(self):
+        helpers.reset_db()
+        restricted_model.setup()
+
+        self.user = factories.User()
+        self.other_user = factories.User()
+        self.dataset = factories.Dataset(
+            maintainer='Maintainer', maintainer_email='maintainer@example.com')
+        self.resource = factories.Resource(package_id=self.dataset['id'])
+        self.orphan_dataset = factories.Dataset()
+        self.orphan_resource = factories.Resource(
+            package_id=self.orphan_dataset['id'])
+
+    def _save(self, user, resource=None, dataset=None, message='Please'):
+        resource = resource or self.resource
+        dataset = dataset or self.dataset
+        access_request = restricted_model.save_access_request(
+            resource['id'], dataset['id'], user['id'], message,
+            dataset.get('maintainer'), dataset.get('maintainer_email'))
+        model.repo.commit()
+        return access_request
+
+    def test_repeated_requests_are_merged(self):
+        first = self._save(self.user, message='Please')
+        second = self._save(self.user, message='Please, again')
+
+        assert_equals(first.id, second.id)
+        assert_equals(second.request_count, 2)
+        requests, count = restricted_model.get_access_requests(
+            resource_id=self.resource['id'])
+        assert_equals(count, 1)
+        assert_equals(requests[0]['message'], 'Please, again')
+
+    def test_requests_of_other_users_are_kept_apart(self):
+        self._save(self.user)
+        self._save(self.other_user)
+
+        requests, count = restricted_model.get_access_requests(
+            resource_id=self.resource['id'])
+        assert_equals(count, 2)
+
+    def test_concurrent_requests_are_merged(self):
+        first = self._save(self.user)
+
+        # the other request read no pending request before this one was
+        # inserted
+        with mock.patch.object(
+                restricted_model, '_get_pending_access_request',
+                side_effect=[None, first]):
+            second = self._save(self.user)
+
+        assert_equals(second.id, first.id)
+        assert_equals(second.request_count, 2)
+        requests, count = restricted_model.get_access_requests(
+            resource_id=self.resource['id'])
+        assert_equals(count, 1)
+
+    @helpers.change_config('email_to', 'admin@example.com')
+    def test_digests(self):
+        self._save(self.user)
+        self._save(self.other_user)
+        self._save(self.user, self.orphan_resource, self.orphan_dataset)
+
+        with mock.patch.object(mailqueue, 'mail_recipients') as send:
+            result = logic.restricted_send_access_request_digests()
+
+        assert_equals(result, {'requests': 3, 'mails': 2})
+        messages = dict((message['recipient_email'], message)
+                        for message in send.call_args[0][0])
+        # one digest per address, the admin gets all the requests
+        assert_equals(sorted(messages),
+                      ['admin@example.com', 'maintainer@example.com'])
+        assert self.orphan_resource['id'] in \
+            messages['admin@example.com']['body']
+        assert self.orphan_resource['id'] not in \
+            messages['maintainer@example.com']['body']
+
+    @helpers.change_config('email_to', 'admin@example.com')
+    def test_digests_only_include_new_requests(self):
+        self._save(self.user)
+
+        with mock.patch.object(mailqueue, 'mail_recipients'):
+            logic.restricted_send_access_request_digests()
+            result = logic.restricted_send_access_request_digests()
+            assert_equals(result, {'requests': 0, 'mails': 0})
+
+            # requested again after the digest
+            self._save(self.user)
+            result = logic.restricted_send_access_request_digests()
+            assert_equals(result['requests'], 1)
@@ -0,0 +1,248 @@
+"""Tests for action.py."""
+import json
+
+import mock
+import nose.tools
+
+import ckan.lib.search as search
+import ckan.logic
+import ckan.model as model
+import ckan.plugins as plugins
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.restricted import action
+from ckanext.restricted import logic
+from ckanext.restricted import model as restricted_model
+
+assert_equals = nose.tools.assert_equals
+
+
+class TestAnonymousPackageShow(object):
+
+    @classmethod
+    def setup_class(cls):
+        if not plugins.plugin_loaded('restricted'):
+            plugins.load('restricted')
+
+    @classmethod
+    def teardown_class(cls):
+        plugins.unload('restricted')
+
+    def setup(self):
+        helpers.reset_db()
+        restricted_model.setup()
+        logic._anonymous_package_cache.clear()
+        logic._decision_cache.clear()
+
+        self.dataset = factories.Dataset()
+        self.restricted_resource = factories.Resource(
+            package_id=self.dataset['id'],
+            restricted=json.dumps({'level': 'only_allowed_users',
+                                   'allowed_users': 'alice,bob'}))
+        self.public_resource = factories.Resource(
+            package_id=self.dataset['id'])
+
+    def _anonymous_package_show(self):
+        return helpers.call_action(
+            'package_show', {'user': '', 'ignore_auth': False,
+                             'model': model},
+            id=self.dataset['id'])
+
+    def _resource_ids(self, dataset):
+        return [resource['id'] for resource in dataset['resources']]
+
+    def test_anonymous_output_is_cached(self):
+        self._anonymous_package_show()
+        dataset = self._anonymous_package_show()
+
+        assert_equals(logic._anonymous_package_cache.size, 1)
+        assert_equals(self._resource_ids(dataset),
+                      [self.public_resource['id']])
+
+    def test_ignore_auth_output_is_not_cached(self):
+        # as the search indexer calls it after every dataset update
+        dataset = helpers.call_action(
+            'package_show', {'user': '', 'ignore_auth': True,
+                             'validate': False, 'model': model},
+            id=self.dataset['id'])
+        assert_equals(len(dataset['resources']), 2)
+        assert_equals(logic._anonymous_package_cache.size, 0)
+
+        dataset = self._anonymous_package_show()
+
+        assert_equals(self._resource_ids(dataset),
+                      [self.public_resource['id']])
+
+    def test_ignore_auth_does_not_get_the_anonymous_output(self):
+        self._anonymous_package_show()
+
+        dataset = helpers.call_action(
+            'package_show', {'user': '', 'ignore_auth': True,
+                             'model': model},
+            id=self.dataset['id'])
+
+        assert_equals(len(dataset['resources']), 2)
+
+
+class TestPackageSearch(object):
+
+    @classmethod
+    def setup_class(cls):
+        if not plugins.plugin_loaded('restricted'):
+            plugins.load('restricted')
+
+    @classmethod
+    def teardown_class(cls):
+        plugins.unload('restricted')
+
+    def setup(self):
+        helpers.reset_db()
+        search.clear_all()
+        restricted_model.setup()
+        logic._anonymous_package_cache.clear()
+
+        self.dataset = factories.Dataset()
+        self.restricted_resource = factories.Resource(
+            package_id=self.dataset['id'],
+            url='http://example.com/restricted.csv',
+            restricted=json.dumps({'level': 'only_allowed_users',
+                                   'allowed_users': 'alice,bob'}))
+        self.public_resource = factories.Resource(
+            package_id=self.dataset['id'],
+            url='http://example.com/public.csv')
+
+    def _anonymous_search(self, **kwargs):
+        return helpers.call_action(
+            'package_search', {'user': '', 'ignore_auth': False,
+                               'model': model}, **kwargs)
+
+    def test_restricted_resources_are_removed(self):
+        result = self._anonymous_search(q='id:{0}'.format(self.dataset['id']))
+
+        assert_equals(result['count'], 1)
+        assert_equals(
+            [resource['id'] for resource in result['results'][0]['resources']],
+            [self.public_resource['id']])
+
+    def test_fl_is_ignored(self):
+        # fields requested with fl would bypass the resource filtering
+        result = self._anonymous_search(
+            q='id:{0}'.format(self.dataset['id']),
+            fl='id,res_url,validated_data_dict')
+
+        dataset = result['results'][0]
+        assert 'res_url' not in dataset
+        assert 'validated_data_dict' not in dataset
+        assert 'restricted.csv' not in json.dumps(result)
+        assert 'alice' not in json.dumps(result)
+        assert_equals(
+            [resource['id'] for resource in dataset['resources']],
+            [self.public_resource['id']])
+
+    def test_restriction_fields_cannot_be_queried(self):
+        nose.tools.assert_raises(
+            ckan.logic.ValidationError, self._anonymous_search,
+            fq='vocab_restricted_allowed_users:"alice"')
+
+    def test_allowed_users_are_not_indexed_by_name(self):
+        result = search.query_for(model.Package).run({
+            'q': 'id:{0}'.format(self.dataset['id']),
+            'fl': 'id vocab_restricted_allowed_users'})
+
+        indexed = result['results'][0]['vocab_restricted_allowed_users']
+        assert_equals(len(indexed), 2)
+        assert 'alice' not in indexed
+        assert logic.restricted_get_index_token('alice') in indexed
+
+    def test_include_restricted_false(self):
+        alice = factories.User(name='alice')
+        restricted_only = factories.Dataset()
+        factories.Resource(
+            package_id=restricted_only['id'],
+            restricted=json.dumps({'level': 'only_allowed_users',
+                                   'allowed_users': 'alice'}))
+
+        def search(user):
+            return helpers.call_action(
+                'package_search', {'user': user, 'ignore_auth': False,
+                                   'model': model},
+                q='id:{0}'.format(restricted_only['id']),
+                include_restricted=False)['count']
+
+        assert_equals(search(alice['name']), 1)
+        assert_equals(search(''), 0)
+
+
+class TestResourceSearch(object):
+    '''restricted_resource_search over a stubbed resource_search.'''
+
+    def setup(self):
+        # every third resource is restricted
+        self.resources = [{
+            'id': 'resource-{0}'.format(i),
+            'restricted': json.dumps({'level': 'registered'})
+            if i % 3 == 0 else ''} for i in range(1037)]
+        self.visible = [resource['id'] for resource in self.resources
+                        if not resource['restricted']]
+        self.calls = []
+        self.patches = [
+            mock.patch.object(action, 'resource_search', self._search),
+            mock.patch.object(action, '_restricted_resource_list_hide_fields',
+                              lambda context, resources: resources)]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def _search(self, context, data_dict):
+        self.calls.append((data_dict['offset'], data_dict['limit']))
+        offset = data_dict['offset']
+        limit = data_dict['limit']
+        return {
+            'count': len(self.resources),
+            'results': self.resources[offset:offset + limit]}
+
+    def _resource_search(self, **kwargs):
+        return action.restricted_resource_search(
+            {'user': ''}, dict(query='name:resource', **kwargs))
+
+    def test_pages(self):
+        for offset, limit in ((0, 10), (5, 100), (300, 250), (600, 100),
+                              (700, 100), (1000, 10)):
+            self.calls = []
+            result = self._resource_search(offset=offset, limit=limit)
+
+            assert_equals([resource['id'] for resource in result['results']],
+                          self.visible[offset:offset + limit])
+            # one call, plus one for the hidden resources of the first
+            # page and one for the end of the search at most
+            assert len(self.calls) <= 3, self.calls
+
+    def test_first_page_is_sized_to_offset_and_limit(self):
+        self._resource_search(offset=500, limit=100)
+
+        assert_equals(self.calls[0], (0, 600))
+
+    def test_count(self):
+        result = self._resource_search(offset=0, limit=10)
+        assert_equals(result['count_exact'], False)
+        assert result['count'] >= len(self.visible)
+
+        result = self._resource_search(offset=0, limit=len(self.resources))
+        assert_equals(result['count_exact'], True)
+        assert_equals(result['count'], len(self.visible))
+
+        result = self._resource_search(offset=600, limit=200)
+        assert_equals(result['count_exact'], True)
+        assert_equals(result['count'], len(self.visible))
+
+    def test_without_limit(self):
+        result = self._resource_search()
+
+        assert_equals([resource['id'] for resource in result['results']],
+                      self.visible)
+        assert_equals(result['count'], len(self.visible))
+        assert_equals(result['count_exact'], True)
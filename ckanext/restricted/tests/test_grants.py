@@ -0,0 +1,197 @@
+"""Tests for the restricted_grant table and the grant actions."""
+import json
+
+import nose.tools
+
+import ckan.logic
+import ckan.model as model
+import ckan.plugins as plugins
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.restricted import auth
+from ckanext.restricted import logic
+from ckanext.restricted import model as restricted_model
+
+assert_equals = nose.tools.assert_equals
+assert_raises = nose.tools.assert_raises
+
+
+def _restricted(level, allowed_users=''):
+    return json.dumps({'level': level, 'allowed_users': allowed_users})
+
+
+class TestGrants(object):
+
+    @classmethod
+    def setup_class(cls):
+        if not plugins.plugin_loaded('restricted'):
+            plugins.load('restricted')
+
+    @classmethod
+    def teardown_class(cls):
+        plugins.unload('restricted')
+
+    def setup(self):
+        helpers.reset_db()
+        restricted_model.setup()
+        logic._decision_cache.clear()
+        logic._user_organization_cache.clear()
+        logic._group_member_cache.clear()
+
+        self.editor = factories.User()
+        self.user = factories.User()
+        self.other_user = factories.User()
+        self.organization = factories.Organization(users=[
+            {'name': self.editor['name'], 'capacity': 'editor'}])
+        self.dataset = factories.Dataset(owner_org=self.organization['id'])
+        self.resource = factories.Resource(
+            package_id=self.dataset['id'],
+            restricted=_restricted(
+                'only_allowed_users', self.other_user['name']))
+
+    def _can_access(self, user_name):
+        # a new context, as a new request would use
+        return logic.restricted_check_user_resource_access(
+            user_name, self.resource, self.dataset, {'model': model})
+
+    def _grant(self, users):
+        return helpers.call_action(
+            'restricted_grant_access', {'user': self.editor['name']},
+            resource_id=self.resource['id'], users=users)
+
+    def test_grant_gives_access(self):
+        assert_equals(self._can_access(self.user['name'])['success'], False)
+
+        result = self._grant(self.user['name'])
+
+        assert_equals(result['granted'], [self.user['name']])
+        assert_equals(result['already_granted'], [])
+        assert_equals(self._can_access(self.user['name'])['success'], True)
+
+    def test_grant_twice(self):
+        self._grant(self.user['name'])
+
+        result = self._grant([self.user['name'], self.user['id']])
+
+        assert_equals(result['granted'], [])
+        assert_equals(result['already_granted'], [self.user['name']])
+
+    def test_grant_unknown_user(self):
+        assert_raises(
+            ckan.logic.ValidationError, self._grant, 'not-a-user')
+
+    def test_revoke_removes_access(self):
+        self._grant(self.user['name'])
+
+        result = helpers.call_action(
+            'restricted_revoke_access', {'user': self.editor['name']},
+            resource_id=self.resource['id'], users=self.user['name'])
+
+        assert_equals(result['revoked'], 1)
+        assert_equals(self._can_access(self.user['name'])['success'], False)
+
+    def test_revoke_allowed_user(self):
+        # allowed users are removed by updating the resource
+        assert_raises(
+            ckan.logic.ValidationError, helpers.call_action,
+            'restricted_revoke_access', {'user': self.editor['name']},
+            resource_id=self.resource['id'], users=self.other_user['name'])
+        assert_equals(
+            self._can_access(self.other_user['name'])['success'], True)
+
+    def test_grant_list(self):
+        self._grant(self.user['name'])
+
+        result = helpers.call_action(
+            'restricted_grant_list', resource_id=self.resource['id'])
+
+        assert_equals(result['count'], 2)
+        assert_equals(
+            sorted((grant['user_name'], grant['source'])
+                   for grant in result['results']),
+            sorted([(self.user['name'], restricted_model.SOURCE_ACTION),
+                    (self.other_user['name'],
+                     restricted_model.SOURCE_METADATA)]))
+
+    def test_grant_list_of_user(self):
+        self._grant(self.user['name'])
+
+        result = helpers.call_action(
+            'restricted_grant_list', {'user': self.user['name']},
+            user_id=self.user['name'])
+
+        assert_equals(result['count'], 1)
+        assert_equals(result['results'][0]['resource_id'],
+                      self.resource['id'])
+
+    def test_grant_not_authorized(self):
+        assert_raises(
+            ckan.logic.NotAuthorized, helpers.call_auth,
+            'restricted_grant_access',
+            {'user': self.user['name'], 'model': model},
+            resource_id=self.resource['id'], users=self.user['name'])
+
+    def test_sync_on_resource_update(self):
+        helpers.call_action(
+            'resource_patch', id=self.resource['id'],
+            restricted=_restricted('only_allowed_users', self.user['name']))
+
+        grants, count = restricted_model.get_grants(
+            resource_id=self.resource['id'])
+
+        assert_equals(count, 1)
+        assert_equals(grants[0]['user_name'], self.user['name'])
+        assert_equals(grants[0]['source'], restricted_model.SOURCE_METADATA)
+
+    def test_sync_keeps_action_grants(self):
+        self._grant(self.user['name'])
+
+        helpers.call_action(
+            'resource_patch', id=self.resource['id'],
+            restricted=_restricted('only_allowed_users', ''))
+
+        grants, count = restricted_model.get_grants(
+            resource_id=self.resource['id'])
+        assert_equals(count, 1)
+        assert_equals(grants[0]['source'], restricted_model.SOURCE_ACTION)
+        assert_equals(self._can_access(self.user['name'])['success'], True)
+        assert_equals(
+            self._can_access(self.other_user['name'])['success'], False)
+
+    def test_sync_with_the_dataset_update(self):
+        # the dataset hooks do not commit, package_update does
+        dataset = helpers.call_action('package_show', id=self.dataset['id'])
+        dataset['resources'][0]['restricted'] = _restricted(
+            'only_allowed_users', self.user['name'])
+        helpers.call_action('package_update', **dataset)
+        model.Session.remove()
+
+        grants, count = restricted_model.get_grants(
+            resource_id=self.resource['id'])
+        assert_equals(count, 1)
+        assert_equals(grants[0]['user_name'], self.user['name'])
+
+    def test_revoke_invalidates_cached_decisions_of_other_processes(self):
+        self._grant(self.user['name'])
+
+        def check():
+            # as resource_show would, with the current resource version
+            resource = helpers.call_action(
+                'resource_show', id=self.resource['id'])
+            return auth.restricted_resource_show(
+                {'user': self.user['name'], 'model': model},
+                {'resource': resource, 'package': self.dataset})['success']
+
+        assert_equals(check(), True)
+        assert_equals(logic._decision_cache.size, 1)
+
+        # another process only sees the database change
+        generations = dict(logic._package_generations)
+        helpers.call_action(
+            'restricted_revoke_access', {'user': self.editor['name']},
+            resource_id=self.resource['id'], users=self.user['name'])
+        logic._package_generations.clear()
+        logic._package_generations.update(generations)
+
+        assert_equals(check(), False)
@@ -0,0 +1,174 @@
+"""Tests for mailqueue.py."""
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import time
+
+import mock
+import nose.tools
+
+from ckanext.restricted import mailqueue
+
+assert_equals = nose.tools.assert_equals
+
+
+class FakeSMTP(object):
+    '''Stands in for smtplib.SMTP, recording the mails sent.'''
+
+    sent = []
+    # recipient email -> exception raised when sending to it
+    errors = {}
+
+    def connect(self, server):
+        pass
+
+    def ehlo(self):
+        pass
+
+    def has_extn(self, name):
+        return True
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, mail_from, recipients, message):
+        error = FakeSMTP.errors.get(recipients[0])
+        if error is not None:
+            raise error
+        FakeSMTP.sent.append(recipients[0])
+
+    def quit(self):
+        pass
+
+
+class TestMailQueue(object):
+
+    def setup(self):
+        self.spool_dir = tempfile.mkdtemp()
+        FakeSMTP.sent = []
+        FakeSMTP.errors = {}
+        self.patches = [
+            mock.patch.object(mailqueue.smtplib, 'SMTP', FakeSMTP),
+            mock.patch.object(mailqueue, 'config', {
+                'ckanext.restricted.mail_spool_dir': self.spool_dir,
+                'smtp.server': 'localhost',
+                'smtp.mail_from': 'ckan@example.com',
+                'ckan.site_title': 'CKAN'})]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.spool_dir)
+
+    def _files(self, folder):
+        return sorted(os.listdir(os.path.join(self.spool_dir, folder)))
+
+    def _enqueue(self, email):
+        return mailqueue.enqueue('Name', email, 'Subject', 'Body')
+
+    def _read(self, folder, file_name):
+        with open(os.path.join(self.spool_dir, folder, file_name)) as f:
+            return json.loads(f.read())
+
+    def test_send_queued(self):
+        self._enqueue('a@example.com')
+        self._enqueue('b@example.com')
+
+        result = mailqueue.send_queued()
+
+        assert_equals(result['sent'], 2)
+        assert_equals(FakeSMTP.sent, ['a@example.com', 'b@example.com'])
+        assert_equals(self._files('new'), [])
+        assert_equals(self._files('cur'), [])
+
+    def test_retry_with_backoff(self):
+        FakeSMTP.errors['a@example.com'] = smtplib.SMTPServerDisconnected()
+        file_name = self._enqueue('a@example.com')
+
+        before = time.time()
+        result = mailqueue.send_queued(max_attempts=3, retry_delay=60)
+
+        assert_equals(result['retried'], 1)
+        message = self._read('new', file_name)
+        assert_equals(message['attempts'], 1)
+        assert message['next_attempt'] >= before + 60
+
+        # not due yet
+        result = mailqueue.send_queued(max_attempts=3, retry_delay=60)
+        assert_equals(result['retried'], 0)
+        assert_equals(self._read('new', file_name)['attempts'], 1)
+
+        # the delay doubles after every failure
+        message['next_attempt'] = 0
+        mailqueue._write_message(self.spool_dir, 'new', file_name, message)
+        before = time.time()
+        mailqueue.send_queued(max_attempts=3, retry_delay=60)
+        message = self._read('new', file_name)
+        assert_equals(message['attempts'], 2)
+        assert message['next_attempt'] >= before + 120
+
+    def test_failed_after_max_attempts(self):
+        FakeSMTP.errors['a@example.com'] = smtplib.SMTPServerDisconnected()
+        file_name = self._enqueue('a@example.com')
+
+        result = mailqueue.send_queued(max_attempts=1)
+
+        assert_equals(result['failed'], 1)
+        assert_equals(self._files('new'), [])
+        assert_equals(self._files('failed'), [file_name])
+
+    def test_claimed_mails_are_requeued_after_the_lease(self):
+        expired = self._enqueue('a@example.com')
+        claimed = self._enqueue('b@example.com')
+        for file_name in (expired, claimed):
+            mailqueue._claim_message(self.spool_dir, file_name)
+        # claimed by a worker that died an hour ago
+        os.utime(os.path.join(self.spool_dir, 'cur', expired),
+                 (time.time() - 3600, time.time() - 3600))
+
+        result = mailqueue.send_queued(lease_timeout=600)
+
+        assert_equals(result['requeued'], 1)
+        assert_equals(FakeSMTP.sent, ['a@example.com'])
+        assert_equals(self._files('cur'), [claimed])
+
+    def test_claim_starts_the_lease(self):
+        file_name = self._enqueue('a@example.com')
+        os.utime(os.path.join(self.spool_dir, 'new', file_name),
+                 (time.time() - 3600, time.time() - 3600))
+        mailqueue._claim_message(self.spool_dir, file_name)
+
+        assert_equals(mailqueue._requeue_expired(self.spool_dir, 600), 0)
+
+    def test_corrupt_mail_is_moved_to_failed(self):
+        mailqueue._ensure_spool_dir()
+        with open(os.path.join(self.spool_dir, 'new', '0-corrupt.json'),
+                  'w') as f:
+            f.write('{"recipient_')
+        self._enqueue('a@example.com')
+
+        result = mailqueue.send_queued()
+
+        assert_equals(result['sent'], 1)
+        assert_equals(self._files('failed'), ['0-corrupt.json'])
+        assert_equals(self._files('cur'), [])
+
+    def test_mail_recipients_skips_refused_recipients(self):
+        mailqueue.config['ckanext.restricted.mail_spool_dir'] = ''
+        FakeSMTP.errors['bad@example.com'] = smtplib.SMTPRecipientsRefused(
+            {'bad@example.com': (550, 'No such user')})
+
+        mailqueue.mail_recipients([
+            {'recipient_name': 'Name', 'recipient_email': email,
+             'subject': 'Subject', 'body': 'Body'}
+            for email in ('a@example.com', 'bad@example.com',
+                          'admin@example.com')])
+
+        assert_equals(FakeSMTP.sent, ['a@example.com', 'admin@example.com'])
@@ -0,0 +1,154 @@
+"""Tests for report.py."""
+import json
+
+import nose.tools
+
+import ckan.authz as authz
+import ckan.model as model
+import ckan.plugins as plugins
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.restricted import logic
+from ckanext.restricted import model as restricted_model
+from ckanext.restricted import report
+
+assert_equals = nose.tools.assert_equals
+
+
+def _restricted(level, allowed_users='', allowed_groups=''):
+    return json.dumps({'level': level, 'allowed_users': allowed_users,
+                       'allowed_groups': allowed_groups})
+
+
+class TestAccessMatrix(object):
+
+    @classmethod
+    def setup_class(cls):
+        if not plugins.plugin_loaded('restricted'):
+            plugins.load('restricted')
+
+    @classmethod
+    def teardown_class(cls):
+        plugins.unload('restricted')
+
+    def setup(self):
+        helpers.reset_db()
+        restricted_model.setup()
+        logic._decision_cache.clear()
+        logic._user_organization_cache.clear()
+        logic._group_member_cache.clear()
+
+        self.users = dict((name, factories.User(name=name)) for name in (
+            'editor', 'member', 'other_member', 'group_member',
+            'group_editor', 'granted', 'alice', 'carol', 'outsider'))
+        self.users['sysadmin'] = factories.Sysadmin(name='sysadmin')
+
+        organization = factories.Organization(users=[
+            {'name': 'editor', 'capacity': 'editor'},
+            {'name': 'member', 'capacity': 'member'}])
+        factories.Organization(users=[
+            {'name': 'other_member', 'capacity': 'member'}])
+        factories.Group(name='trusted', users=[
+            {'name': 'group_member', 'capacity': 'member'},
+            {'name': 'group_editor', 'capacity': 'admin'}])
+
+        dataset = factories.Dataset(owner_org=organization['id'])
+        private_dataset = factories.Dataset(
+            owner_org=organization['id'], private=True)
+        self.resources = []
+        for package, restricted in (
+                (dataset, _restricted('public')),
+                (dataset, _restricted('registered')),
+                (dataset, _restricted('any_organization')),
+                (dataset, _restricted('same_organization')),
+                (dataset, _restricted('only_allowed_users', 'alice')),
+                (dataset, _restricted('only_allowed_users', '',
+                                      'trusted:editor')),
+                (dataset, _restricted('same_organization', 'alice',
+                                      'trusted')),
+                (dataset, _restricted('only_allowed_users')),
+                (private_dataset, _restricted('public')),
+                (private_dataset, _restricted('registered', 'alice')),
+                (private_dataset, _restricted('only_allowed_users',
+                                              'member'))):
+            self.resources.append(factories.Resource(
+                package_id=package['id'], restricted=restricted))
+        self.packages = {dataset['id']: dataset,
+                         private_dataset['id']: private_dataset}
+
+        # granted on the allowed users only resource
+        helpers.call_action(
+            'restricted_grant_access', {'user': 'sysadmin'},
+            resource_id=self.resources[7]['id'],
+            users='granted')
+
+        # saved before the values were normalized, with spaces
+        legacy = model.Resource.get(self.resources[4]['id'])
+        extras = dict(legacy.extras)
+        extras['restricted'] = _restricted(
+            'only_allowed_users', 'alice, carol')
+        model.Session.execute(model.resource_table.update().where(
+            model.resource_table.c.id == legacy.id).values(extras=extras))
+        model.repo.commit()
+        self.resources[4] = helpers.call_action(
+            'resource_show', id=legacy.id)
+
+    def _expected(self, user_name, resource):
+        context = {'user': user_name, 'model': model}
+        package_id = resource['package_id']
+        if authz.is_authorized('package_update', dict(context),
+                               {'id': package_id})['success']:
+            return True
+        if not authz.is_authorized('package_show', dict(context),
+                                   {'id': package_id})['success']:
+            return False
+        return logic.restricted_check_user_resource_access(
+            user_name, resource, self.packages[package_id],
+            dict(context))['success']
+
+    def test_matches_restricted_check_user_resource_access(self):
+        matrix = dict(
+            ((row['resource_id'], row['user_name']), row['access'])
+            for row in report.iter_access_matrix(
+                include_denied=True, expand_registered=True))
+
+        users = [name for name, in model.Session.query(
+            model.User.name).filter(model.User.state == 'active')]
+        reported = set(resource_id for resource_id, _name in matrix)
+        for resource in self.resources:
+            policy = logic.restricted_get_restriction_policy(resource)
+            if policy.is_public and \
+                    not self.packages[resource['package_id']]['private']:
+                # not restricted, not reported
+                assert resource['id'] not in reported
+                continue
+            for user_name in users:
+                assert_equals(
+                    matrix.get((resource['id'], user_name)),
+                    self._expected(user_name, resource),
+                    '{0} on {1}'.format(user_name, resource['restricted']))
+
+    def test_reasons(self):
+        reasons = dict(
+            ((row['resource_id'], row['user_name']), row['reason'])
+            for row in report.iter_access_matrix())
+
+        def reason(index, user_name):
+            return reasons.get((self.resources[index]['id'], user_name))
+
+        assert_equals(reason(1, report.ALL_USERS), 'registered')
+        assert_equals(reason(4, 'alice'), 'allowed_user')
+        # " carol" does not match, as in the live check
+        assert_equals(reason(4, 'carol'), None)
+        assert_equals(reason(5, 'group_editor'), 'allowed_group')
+        assert_equals(reason(5, 'group_member'), None)
+        assert_equals(reason(7, 'granted'), 'grant')
+        assert_equals(reason(7, 'sysadmin'), 'sysadmin')
+        assert_equals(reason(7, 'editor'), 'editor')
+        assert_equals(reason(3, 'member'), 'same_organization')
+        assert_equals(reason(2, 'other_member'), 'any_organization')
+        # private dataset, only the organization members
+        assert_equals(reason(9, report.ALL_USERS), None)
+        assert_equals(reason(9, 'member'), 'registered')
+        assert_equals(reason(9, 'alice'), None)
@@ -81,6 +81,8 @@ setup(
     entry_points='''
         [ckan.plugins]
         restricted=ckanext.restricted.plugin:RestrictedPlugin
+        [paste.paster_command]
+        restricted=ckanext.restricted.commands:RestrictedCommand
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
     ''',